@@ -15,44 +15,68 @@
 # 
 # You should have received a copy of the GNU General Public License
 # along with pybindings.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import ast
+import fnmatch
 import os
-# import subprocess
 import re
-from cppentities import CPPClass, CPPConstructor, CPPDestructor, CPPMethod
+import shutil
+import subprocess
+import tempfile
+import unittest
+from cppentities import CPPClass, CPPConstructor, CPPDestructor, CPPMember, CPPMethod
 from writers import PyAPIWriter
 
+HEADER_EXTENSIONS = ('.h', '.hh', '.hpp', '.hxx')
+
 
 class TagFile(object):
     """
     Object allowing to manipulate a tag file generated with exuberant ctags.
+    If 'content' is given, it is the text of the tags, which are then not
+    read from the file 'tagFile'.
     """
-    def __init__(self, tagFile):
+    def __init__(self, tagFile=None, content=None):
         self._file = tagFile
+        self._lines = None
+        if content is not None:
+            self._lines = content.splitlines(True)
+
+    def _readLines(self):
+        if self._lines is not None:
+            return self._lines
+        return open(self._file)
 
-    def generateClassNamesAndFiles(self, classesAndFiles):
+    def generateClassNamesAndFiles(self, classesAndFiles, structures=False):
         """
-        Retrieve all the classes defined in the tagfile and the *.h file they come from.
+        Retrieve all the classes defined in the tagfile and the *.h file they come from,
+        and also the structs if 'structures' is True.
 
         The parameter 'classes' is a list of tuples (className, classHeaderFileName)
         """
         print('Generating classes collection.')
-        classRegex = re.compile(r'\tc$')
-        for line in open(self._file):
+        classRegex = re.compile(r'\t[cs]$' if structures else r'\tc$')
+        for line in self._readLines():
             if classRegex.search(line):
                 # The first word is the tag name, it's the name of the class.
                 # The second word is the header file it comes from.
                 classesAndFiles.append((line.strip().split()[0], line.strip().split()[1]))
 
-    def retrieveMethodsForClass(self, class_):
+    def retrieveMethodsForClass(self, class_, selection=None):
         """
         Retrieve all the methods prototypes corresponding
-        to the given class name.
+        to the given class name. If a Selection is given, the methods
+        it does not select are skipped before being parsed.
         """
         print('Retrieving methods for class ' + class_.getName() + '.')
-        methodRegex = re.compile(r'^\s*~?\w+\s+.*\tf\tclass:' + class_.getName() + '$')
+        methodRegex = re.compile(r'^\s*~?\w+\s+.*\tf\t(class|struct):' + class_.getName() + '$')
         prototypeRegex = re.compile(r'\/\^(.+)\$\/;\"')
-        for line in open(self._file):
+        for line in self._readLines():
             if methodRegex.search(line):
+                # The first word is the tag name, i.e. the name of the method.
+                if selection and not selection.acceptsMethod(class_.getName(),
+                        line.strip().split()[0]):
+                    continue
                 # print(line)
                 # Get the prototype of the method, constructor or destructor
                 # contained in the line.
@@ -75,6 +99,140 @@ class TagFile(object):
                             raise Exception('The given line does not appear to'
                             'be a valid C++ prototype line at all...')
 
+    def retrieveMembersForClass(self, class_):
+        """
+        Retrieve the data members of the given class or struct from their 'm'
+        tags, and mark its layout as hidden if it derives from other classes or
+        has virtual methods, see CPPClass.isPOD.
+        """
+        print('Retrieving members for class ' + class_.getName() + '.')
+        name = re.escape(class_.getName())
+        classRegex = re.compile(r'^' + name + r'\t.*\t[cs](\t.*)?$')
+        memberRegex = re.compile(r'^(\w+)\t.*\tm\t(class|struct):' + name + r'(\t.*)?$')
+        methodRegex = re.compile(r'^~?\w+\t.*\tf\t(class|struct):' + name + r'(\t.*)?$')
+        prototypeRegex = re.compile(r'\/\^(.+)\$\/;\"')
+        for line in self._readLines():
+            line = line.rstrip('\n')
+            if classRegex.search(line):
+                declaration = prototypeRegex.search(line).group(1)
+                if (re.search(r'\b(class|struct)\s+' + name + r'\s*:(?!:)', declaration) or
+                        '\tinherits:' in line):
+                    class_.setHiddenLayout()
+            elif methodRegex.search(line):
+                if re.search(r'\bvirtual\b', prototypeRegex.search(line).group(1)):
+                    class_.setHiddenLayout()
+            elif memberRegex.search(line):
+                # Exuberant ctags marks the private members as file scoped.
+                fields = line.split('\t')
+                public = ('file:' not in fields and
+                        all(field == 'access:public' for field in fields
+                        if field.startswith('access:')))
+                try:
+                    class_.addMember(CPPMember(memberRegex.search(line).group(1),
+                            prototypeRegex.search(line).group(1), public))
+                except ValueError:
+                    class_.setHiddenLayout()
+
+
+class Selection(object):
+    """
+    Glob patterns selecting the headers, classes and methods to bind. An
+    entity is selected if it matches one of the include patterns, or if
+    there are none, and none of the exclude patterns. The method patterns
+    containing a dot, like 'Stuff.get*', are matched against the qualified
+    name of the method, the others against its name only. The constructors
+    and the destructor are always selected.
+
+    The skipped entities are recorded for the report.
+    """
+    def __init__(self, headers=None, excludedHeaders=None, classes=None,
+            excludedClasses=None, methods=None, excludedMethods=None):
+        self._headers = headers or []
+        self._excludedHeaders = excludedHeaders or []
+        self._classes = classes or []
+        self._excludedClasses = excludedClasses or []
+        self._methods = methods or []
+        self._excludedMethods = excludedMethods or []
+        self.skippedHeaders = []
+        self.skippedClasses = []
+        self.skippedMethods = []
+
+    def __bool__(self):
+        return bool(self._headers or self._excludedHeaders or self._classes or
+                self._excludedClasses or self._methods or self._excludedMethods)
+
+    __nonzero__ = __bool__
+
+    def _matches(self, name, patterns, excludedPatterns):
+        if patterns and not any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+            return False
+        return not any(fnmatch.fnmatchcase(name, pattern) for pattern in excludedPatterns)
+
+    def hasHeaderPatterns(self):
+        return bool(self._headers or self._excludedHeaders)
+
+    def isHeaderSelected(self, header):
+        return self._matches(header, self._headers, self._excludedHeaders)
+
+    def filterHeaders(self, headers):
+        """Return the list of the selected header paths of the list 'headers'."""
+        selected = []
+        for header in headers:
+            if self.isHeaderSelected(header):
+                selected.append(header)
+            elif header not in self.skippedHeaders:
+                self.skippedHeaders.append(header)
+        return selected
+
+    def filterClasses(self, classesAndFiles):
+        """
+        Return the list of the selected classes of the list
+        of tuples (className, classHeaderFileName) 'classesAndFiles'.
+        """
+        selected = []
+        for className, header in classesAndFiles:
+            if (self._matches(className, self._classes, self._excludedClasses) and
+                    self.isHeaderSelected(header)):
+                selected.append((className, header))
+            elif className + ' (' + header + ')' not in self.skippedClasses:
+                self.skippedClasses.append(className + ' (' + header + ')')
+        return selected
+
+    def acceptsMethod(self, className, methodName):
+        """Return True if the method 'methodName' of the class 'className' is selected."""
+        if methodName in (className, '~' + className):
+            return True
+        qualifiedName = className + '.' + methodName
+        methods = [pattern for pattern in self._methods if '.' not in pattern]
+        qualifiedMethods = [pattern for pattern in self._methods if '.' in pattern]
+        selected = (not self._methods or
+                any(fnmatch.fnmatchcase(methodName, pattern) for pattern in methods) or
+                any(fnmatch.fnmatchcase(qualifiedName, pattern) for pattern in qualifiedMethods))
+        for pattern in self._excludedMethods:
+            name = qualifiedName if '.' in pattern else methodName
+            if fnmatch.fnmatchcase(name, pattern):
+                selected = False
+        if not selected and qualifiedName not in self.skippedMethods:
+            self.skippedMethods.append(qualifiedName)
+        return selected
+
+    def getReport(self):
+        """Return the report of the skipped headers, classes and methods."""
+        report = 'Selection report:\n'
+        for title, skipped in (('headers', self.skippedHeaders),
+                ('classes', self.skippedClasses), ('methods', self.skippedMethods)):
+            report += '    Skipped ' + title + ' (' + str(len(skipped)) + ')'
+            if skipped:
+                report += ': ' + ', '.join(skipped)
+            report += '\n'
+        return report
+
+
+def createSelection(options):
+    """Return the Selection corresponding to the parsed command line options."""
+    return Selection(options.headers, options.exclude_headers, options.classes,
+            options.exclude_classes, options.methods, options.exclude_methods)
+
 
 def parseHeader(headerPath):
     print('Parsing header: ' + headerPath)
@@ -86,32 +244,124 @@ def parseHeader(headerPath):
                 print(classRegex.match(line).groups())
 
 
-def generateTagsForCurrentDir(tagFilePath):
+def listTaggedFiles(directory='.', selection=None):
     """
-    Generate a tag file for all the C++ headers in the current directory.
+    Return the names of the files of the directory 'directory' to tag: all of
+    them, or only the C++ headers selected by the Selection 'selection' if it
+    has header patterns.
+    """
+    files = sorted(name for name in os.listdir(directory)
+            if not name.startswith('.') and os.path.isfile(os.path.join(directory, name)))
+    if selection and selection.hasHeaderPatterns():
+        files = selection.filterHeaders([name for name in files
+                if name.endswith(HEADER_EXTENSIONS)])
+    return files
+
+
+def generateTags(files, directory=None):
+    """
+    Return the text of the tags of the C++ headers in the list 'files',
+    whose paths are relative to the directory 'directory', the current
+    directory by default.
     """
     print('Generating tags...')
-    # FIXME why subprocess.check_call() does not work on Ubuntu but
-    # it works on Debian?
-    cmd = 'ctags --extra=+q --exclude=*.cpp --exclude=*.c --languages=C++ -f ' + tagFilePath + ' *'
-    os.system(cmd)
-    # try:
-        # subprocess.check_call(cmd)
-    # except Exception:
-        # print('A problem occured during the generation of the tags.\n'
-            # 'Exuberant Ctags is probably not available on your system.\n'
-            # 'For Windows, you can find an installer here: http://ctags.sourceforge.net/\n'
-            # 'For Linux systems, install the corresponding package.\n'
-            # 'On Debian and Ubuntu it is called \'exuberant-ctags\'.')
-        # raise
-
-def main():
-    tagFilePath = 'pybindings.tags'
-    generateTagsForCurrentDir(tagFilePath)
-
-    tagFile = TagFile(tagFilePath)
+    if not files:
+        # Without files, ctags would read the list of files from stdin.
+        return ''
+    cmd = (['ctags', '--extra=+q', '--exclude=*.cpp', '--exclude=*.c', '--languages=C++',
+            '-f', '-'] + list(files))
+    try:
+        return subprocess.check_output(cmd, cwd=directory).decode()
+    except OSError:
+        print('A problem occured during the generation of the tags.\n'
+            'Exuberant Ctags is probably not available on your system.\n'
+            'For Windows, you can find an installer here: http://ctags.sourceforge.net/\n'
+            'For Linux systems, install the corresponding package.\n'
+            'On Debian and Ubuntu it is called \'exuberant-ctags\'.')
+        raise
+
+
+def createArgumentParser(description='Automatically build Python '
+        'bindings from the C++ headers of the current directory.'):
+    """Return the parser of the command line options of the script."""
+    # The options can also be read from files given as @file, one option per
+    # line, which is handy to keep a selection of the classes to bind.
+    parser = argparse.ArgumentParser(description=description, fromfile_prefix_chars='@')
+    parser.add_argument('--accounting', action='store_true',
+            help='count the live native objects and allocated bytes of each '
+            'class and expose them in the Python wrapper')
+    parser.add_argument('--stress-harness', action='store_true',
+            help='also generate a harness running every bound method from '
+            'several threads and processes to measure scaling')
+    parser.add_argument('--per-class-modules', action='store_true',
+            help='write the Python wrapper as a package with one module per '
+            'class, imported on first access')
+    parser.add_argument('--jobs', type=int, default=1,
+            help='number of processes rendering the classes concurrently')
+    parser.add_argument('--command-buffer', action='store_true',
+            help='let the Python wrapper record sequences of method calls and '
+            'execute them with a single native call')
+    parser.add_argument('--memoize', type=int, nargs='?', const=8, default=0, metavar='N',
+            help='cache the results of up to N (default 8) zero-argument const '
+            'methods in each Python object, until a non-const method is called')
+    parser.add_argument('--pickle', action='store_true',
+            help='make the Python objects picklable through the serialize() and '
+            'deserialize() methods of the C++ classes')
+    parser.add_argument('--thread-safe', action='store_true',
+            help='lock the objects in the C API so that they can be used from '
+            'several threads, const methods taking a shared lock')
+    parser.add_argument('--precompiled-header', action='store_true',
+            help='write the includes of the C API implementation to a header '
+            'which can be precompiled')
+    parser.add_argument('--dispatch-table', action='store_true',
+            help='export a single table of the functions of the C API from the '
+            'library instead of one symbol per function')
+    parser.add_argument('--identity-map', action='store_true',
+            help='return the Python wrappers of the objects returned by pointer '
+            'or reference, reusing one wrapper per native object')
+    parser.add_argument('--owned-results', action='append', metavar='PATTERN',
+            help='the pointers returned by the methods matching PATTERN, a method '
+            'name or Class.method, are owned by the caller. Can be repeated')
+    parser.add_argument('--shared-handles', action='store_true',
+            help='count the owners of the objects in the C API and add a share() '
+            'method to the Python wrappers')
+    parser.add_argument('--pod-structures', action='store_true',
+            help='wrap the plain old data classes with ctypes structures passed by value, '
+            'and their vectors with NumPy structured arrays')
+    selection = parser.add_argument_group('selection', 'Glob patterns selecting the '
+            'headers, classes and methods to bind. Each option can be repeated.')
+    selection.add_argument('--headers', action='append', metavar='PATTERN',
+            help='bind only the headers matching PATTERN')
+    selection.add_argument('--exclude-headers', action='append', metavar='PATTERN',
+            help='do not bind the headers matching PATTERN')
+    selection.add_argument('--classes', action='append', metavar='PATTERN',
+            help='bind only the classes matching PATTERN')
+    selection.add_argument('--exclude-classes', action='append', metavar='PATTERN',
+            help='do not bind the classes matching PATTERN')
+    selection.add_argument('--methods', action='append', metavar='PATTERN',
+            help='bind only the methods matching PATTERN, a method name or Class.method')
+    selection.add_argument('--exclude-methods', action='append', metavar='PATTERN',
+            help='do not bind the methods matching PATTERN, a method name or Class.method')
+    return parser
+
+
+def parseArguments(argv=None):
+    """Parse the command line options of the script."""
+    return createArgumentParser().parse_args(argv)
+
+
+def parseClasses(tagFile, selection=None, structures=False):
+    """
+    Parse the classes defined in the TagFile 'tagFile'. Return the list of
+    the CPPClass found and the list of the headers they come from. If a
+    Selection is given, only the classes and methods it selects are parsed.
+    If 'structures' is True, the structs are parsed too, as well as the
+    data members needed to wrap the plain old data classes as structures.
+    """
     classesAndFiles = []
-    tagFile.generateClassNamesAndFiles(classesAndFiles)
+    tagFile.generateClassNamesAndFiles(classesAndFiles, structures)
+    if selection:
+        classesAndFiles = selection.filterClasses(classesAndFiles)
     print('Classes found in tags file:')
     for classAndFile in classesAndFiles:
         print('    ' + classAndFile[0] + ' from file ' + classAndFile[1])
@@ -119,18 +369,256 @@ def main():
     includes = []
     for classAndFile in classesAndFiles:
         newClass = CPPClass(classAndFile[0])
-        tagFile.retrieveMethodsForClass(newClass)
+        tagFile.retrieveMethodsForClass(newClass, selection)
+        if structures:
+            tagFile.retrieveMembersForClass(newClass)
         classes.append(newClass)
         includes.append(classAndFile[1])
+    return classes, includes
+
+
+def writeBindings(classes, includes, options, name='pyndings', inMemory=False,
+        renderedFragments=None):
+    """
+    Write the C API and the Python wrapper of the CPPClass collection
+    'classes' to the current directory, with 'options' the parsed
+    command line options. The files are named after 'name' and the
+    wrapper loads the library 'lib<name>.so'.
+
+    If 'inMemory' is True, nothing is written and the dictionary of the
+    texts of the files, by file name, is returned instead.
+
+    'renderedFragments' is the optional dictionary of the ClassFragments of
+    the classes rendered by a previous call with the same options, by class
+    name, see PyAPIWriter.writeClasses.
+    """
+    apiWriter = PyAPIWriter(name, includes, 'lib' + name + '.so',
+            accounting=options.accounting,
+            stressHarness=options.stress_harness,
+            perClassModules=options.per_class_modules,
+            jobs=options.jobs,
+            commandBuffer=options.command_buffer,
+            memoize=options.memoize,
+            pickling=options.pickle,
+            threadSafe=options.thread_safe,
+            inMemory=inMemory,
+            precompiledHeader=options.precompiled_header,
+            dispatchTable=options.dispatch_table,
+            identityMap=options.identity_map,
+            sharedHandles=options.shared_handles,
+            podStructures=options.pod_structures,
+            ownedResults=options.owned_results)
+    apiWriter.writeClasses(classes, renderedFragments)
+    if inMemory:
+        return apiWriter.getOutputs()
+
+
+class Bindings(object):
+    """
+    Result of generateBindings: the parsed CPPClass model and the texts of
+    the generated files.
+    """
+    def __init__(self, classes, includes, files, selection):
+        self._classes = classes
+        self._includes = includes
+        self._files = files
+        self._selection = selection
+
+    def getClasses(self):
+        """Return the list of the parsed CPPClass."""
+        return self._classes
+
+    def getIncludes(self):
+        """Return the list of the headers the classes come from."""
+        return self._includes
+
+    def getFiles(self):
+        """Return the dictionary of the texts of the generated files, by file name."""
+        return self._files
+
+    def getSelection(self):
+        """Return the Selection used to parse the classes."""
+        return self._selection
+
+    def write(self, directory='.'):
+        """Write the generated files to the directory 'directory'."""
+        for filename, text in sorted(self._files.items()):
+            path = os.path.join(directory, filename)
+            if not os.path.isdir(os.path.dirname(path) or '.'):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fp:
+                fp.write(text)
+
+
+def generateBindings(headers=None, sources=None, options=None, directory=None,
+        name='pyndings'):
+    """
+    Generate the bindings in memory and return them as a Bindings object.
+
+    - headers is the list of the paths of the headers to bind, relative to
+    'directory'. By default, all the headers of 'directory' are bound, like
+    the command line does for the current directory.
+    - sources is a dictionary of the texts of headers to bind, by header name.
+    Since ctags only reads files, they are written to a private temporary
+    directory for the time of the tagging.
+    - options are the parsed command line options, see parseArguments.
+    The default options are used if not given.
+    - directory is the directory of the headers read from the disk. It must
+    be given unless all the headers are given as sources.
+    - name is the name of the generated files, see writeBindings.
+
+    Neither the current directory nor any shared file is used, so that
+    several bindings can be generated at the same time in one process.
+    """
+    if directory is None and (headers or (headers is None and sources is None)):
+        raise ValueError('The directory of the headers must be given.')
+    if options is None:
+        options = parseArguments([])
+    selection = createSelection(options)
+    tags = ''
+    if headers is None and sources is None:
+        tags += generateTags(listTaggedFiles(directory, selection), directory)
+    elif headers:
+        tags += generateTags(selection.filterHeaders(headers) if selection else headers,
+                directory)
+    if sources:
+        names = sorted(sources)
+        if selection:
+            names = selection.filterHeaders(names)
+        sourceDirectory = tempfile.mkdtemp(prefix='pybindings')
+        try:
+            for header in names:
+                path = os.path.join(sourceDirectory, header)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as fp:
+                    fp.write(sources[header])
+            tags += generateTags(names, sourceDirectory)
+        finally:
+            shutil.rmtree(sourceDirectory)
+    classes, includes = parseClasses(TagFile(content=tags), selection, options.pod_structures)
+    files = writeBindings(classes, includes, options, name, inMemory=True)
+    return Bindings(classes, includes, files, selection)
+
+
+def main(argv=None):
+    options = parseArguments(argv)
+    bindings = generateBindings(options=options, directory='.')
+    bindings.write()
+    if bindings.getSelection():
+        print(bindings.getSelection().getReport())
+
+
+class SelectionTester(unittest.TestCase):
+    """Class to unit test the Selection."""
+    def testEmptySelectionSelectsEverything(self):
+        selection = Selection()
+        self.assertFalse(selection)
+        self.assertTrue(selection.isHeaderSelected('include/Stuff.h'))
+        self.assertTrue(selection.acceptsMethod('Stuff', 'getValue'))
+
+    def testGlobPatterns(self):
+        selection = Selection(headers=['include/*.h'], classes=['[A-C]*'])
+        self.assertTrue(selection.isHeaderSelected('include/Stuff.h'))
+        self.assertFalse(selection.isHeaderSelected('src/Stuff.h'))
+        self.assertEqual(selection.filterClasses([('Banana', 'include/Fruit.h'),
+                ('Durian', 'include/Fruit.h'), ('Cherry', 'src/Fruit.h')]),
+                [('Banana', 'include/Fruit.h')])
+        self.assertEqual(len(selection.skippedClasses), 2)
+
+    def testPatternsAreNotRegularExpressions(self):
+        selection = Selection(classes=['Stuff.*'], excludedMethods=['get.+'])
+        self.assertEqual(selection.filterClasses([('StuffFactory', 'Stuff.h')]), [])
+        self.assertTrue(selection.acceptsMethod('Stuff', 'getValue'))
+
+    def testExcludePatternsTakePrecedence(self):
+        selection = Selection(headers=['*.h'], excludedHeaders=['*_private.h'],
+                classes=['Stuff*'], excludedClasses=['*Impl'])
+        self.assertTrue(selection.isHeaderSelected('Stuff.h'))
+        self.assertFalse(selection.isHeaderSelected('Stuff_private.h'))
+        self.assertEqual(selection.filterClasses([('Stuff', 'Stuff.h'), ('StuffImpl', 'Stuff.h'),
+                ('Stuff', 'Stuff_private.h')]), [('Stuff', 'Stuff.h')])
+
+    def testQualifiedMethodPatterns(self):
+        selection = Selection(methods=['get*', 'Stuff.set*'], excludedMethods=['Stuff.getSecret'])
+        self.assertTrue(selection.acceptsMethod('Stuff', 'getValue'))
+        self.assertTrue(selection.acceptsMethod('Stuff', 'setValue'))
+        self.assertFalse(selection.acceptsMethod('Other', 'setValue'))
+        self.assertTrue(selection.acceptsMethod('Other', 'getSecret'))
+        self.assertFalse(selection.acceptsMethod('Stuff', 'getSecret'))
+        self.assertEqual(selection.skippedMethods, ['Other.setValue', 'Stuff.getSecret'])
+
+    def testConstructorsAndDestructorAreAlwaysSelected(self):
+        selection = Selection(excludedMethods=['*'])
+        self.assertTrue(selection.acceptsMethod('Stuff', 'Stuff'))
+        self.assertTrue(selection.acceptsMethod('Stuff', '~Stuff'))
+        self.assertFalse(selection.acceptsMethod('Stuff', 'getValue'))
+
+
+class TagFileTester(unittest.TestCase):
+    """Class to unit test the parsing of the TagFile."""
+    TAGS = ('Derived\tShapes.h\t/^class Derived : public Point$/;"\tc\n'
+            'Point\tShapes.h\t/^struct Point$/;"\ts\n'
+            'Shape\tShapes.h\t/^class Shape$/;"\tc\n'
+            'area\tShapes.h\t/^    virtual double area() const;$/;"\tf\tclass:Shape\n'
+            'length\tShapes.h\t/^    double length() const;$/;"\tf\tstruct:Point\n'
+            'm_id\tShapes.h\t/^    int m_id;$/;"\tm\tclass:Shape\tfile:\n'
+            'x\tShapes.h\t/^    double x;$/;"\tm\tstruct:Point\n'
+            'y\tShapes.h\t/^    double y;$/;"\tm\tstruct:Point\n')
+
+    def testStructsAreOnlyFoundForStructures(self):
+        classesAndFiles = []
+        TagFile(content=self.TAGS).generateClassNamesAndFiles(classesAndFiles)
+        self.assertEqual([className for className, header in classesAndFiles],
+                ['Derived', 'Shape'])
+        classesAndFiles = []
+        TagFile(content=self.TAGS).generateClassNamesAndFiles(classesAndFiles, True)
+        self.assertEqual([className for className, header in classesAndFiles],
+                ['Derived', 'Point', 'Shape'])
+
+    def testRetrieveMembersForStruct(self):
+        point = CPPClass('Point')
+        tagFile = TagFile(content=self.TAGS)
+        tagFile.retrieveMethodsForClass(point)
+        tagFile.retrieveMembersForClass(point)
+        self.assertEqual([member.getName() for member in point.getMembers()], ['x', 'y'])
+        self.assertEqual(len(point.getMethods()), 1)
+        self.assertTrue(point.isPOD())
+
+    def testRetrieveMembersForHiddenLayouts(self):
+        tagFile = TagFile(content=self.TAGS)
+        for className in ('Derived', 'Shape'):
+            class_ = CPPClass(className)
+            tagFile.retrieveMembersForClass(class_)
+            self.assertFalse(class_.isPOD())
+        shape = CPPClass('Shape')
+        tagFile.retrieveMembersForClass(shape)
+        self.assertFalse(shape.getMembers()[0].isPublic())
+
+    def testMembersAreOnlyParsedForStructures(self):
+        classes, includes = parseClasses(TagFile(content=self.TAGS))
+        self.assertEqual([class_.getMembers() for class_ in classes], [[], []])
+        classes, includes = parseClasses(TagFile(content=self.TAGS), structures=True)
+        self.assertEqual([class_.isPOD() for class_ in classes], [False, True, False])
+
 
-    # Write the C API file:
-    apiFilename = 'pyndings'
-    library = 'libpyndings.so'
-    apiWriter = PyAPIWriter(apiFilename, includes, library)
-    apiWriter.writeClasses(classes)
+class WriteBindingsTester(unittest.TestCase):
+    """Class to unit test the bindings generated in memory."""
+    TAGS = ('Point\tPoint.h\t/^struct Point$/;"\ts\n'
+            'tags\tPoint.h\t/^    int tags[3];$/;"\tm\tstruct:Point\n'
+            'x\tPoint.h\t/^    double x;$/;"\tm\tstruct:Point\n'
+            'y\tPoint.h\t/^    double y;$/;"\tm\tstruct:Point\n')
 
-    # Remove temporary files.
-    os.remove(tagFilePath)
+    def testStructureWrapperIsValid(self):
+        for arguments in (['--pod-structures'], ['--pod-structures', '--per-class-modules']):
+            options = parseArguments(arguments)
+            classes, includes = parseClasses(TagFile(content=self.TAGS), structures=True)
+            files = writeBindings(classes, includes, options, inMemory=True)
+            wrappers = [filename for filename in files if filename.endswith('.py')]
+            self.assertTrue(wrappers)
+            for filename in wrappers:
+                ast.parse(files[filename], filename)
+            self.assertIn('testLayout', ''.join(files[filename] for filename in wrappers))
 
 
 if __name__ == '__main__':
@@ -15,10 +15,42 @@
 # 
 # You should have received a copy of the GNU General Public License
 # along with pybindings.  If not, see <http://www.gnu.org/licenses/>.
+import pickle
 import re
 import unittest
 
 
+class PickledMatch(object):
+    """
+    Picklable copy of a regular expression match object, keeping what
+    the C++ entities use once they are parsed. This allows to send the
+    entities to other processes without parsing them again.
+    """
+    def __init__(self, match):
+        self.string = match.string
+        self._group = match.group()
+        self._groups = match.groups()
+
+    def group(self, index=0):
+        if index == 0:
+            return self._group
+        else:
+            return self._groups[index - 1]
+
+    def groups(self):
+        return self._groups
+
+
+def getPicklableState(entity):
+    """
+    Return the attributes of the C++ entity 'entity' to pickle,
+    where its match object is replaced by a PickledMatch.
+    """
+    state = entity.__dict__.copy()
+    state['_match'] = PickledMatch(entity._match)
+    return state
+
+
 class CPPClass(object):
     """
     A whole C++ class with all its potential constructors,
@@ -30,6 +62,8 @@ class CPPClass(object):
         self._constructors = []
         self._destructor = None
         self._methods = []
+        self._members = []
+        self._hiddenLayout = False
 
     def getName(self):
         return self._name
@@ -61,6 +95,31 @@ class CPPClass(object):
         else:
             return False
 
+    def addMember(self, member):
+        self._members.append(member)
+
+    def getMembers(self):
+        return self._members
+
+    def setHiddenLayout(self):
+        """
+        Mark the layout of the class as not known from its data members,
+        because it has base classes, virtual methods or members which could
+        not be parsed.
+        """
+        self._hiddenLayout = True
+
+    def isPOD(self):
+        """
+        Return True if the class is a plain old data: its objects are made of
+        their public non-static data members only, without pointers, and are
+        created, copied and destroyed without running any code.
+        """
+        members = [member for member in self._members if not member.isStatic()]
+        return (len(members) > 0 and not self._hiddenLayout and not self._constructors and
+                not self._destructor and all(member.isPublic() and not member.isConst() and
+                not member.isPointer() for member in members))
+
     def __str__(self):
         string = ''
         for constructor in self._constructors:
@@ -75,10 +134,29 @@ class CPPValue(object):
     """
     CPPValue represents a C++ value type, that is, a type and its
     attributes (const and/or pointer or reference).
+
+    The type may have one level of template arguments, like in
+    'std::vector<double>'; nested templates are not handled.
     """
     def __init__(self, valueString):
+        # The template arguments are removed before matching the pattern and
+        # put back in the matched string afterwards.
+        templateMatch = re.search(CPPValue.getTemplatePattern(), valueString)
+        self._templateArguments = []
+        if templateMatch:
+            self._templateArguments = [argument.strip()
+                    for argument in templateMatch.group(1).split(',')]
+            valueString = valueString[:templateMatch.start()] + valueString[templateMatch.end():]
+
         if re.match(CPPValue.getPattern(), valueString):
             self._match = re.match(CPPValue.getPattern(), valueString)
+            self._matchedString = self._match.group()
+            if templateMatch:
+                # Insert the template arguments back just after the type.
+                typeGroup = 4 if self._match.group(3) else 2
+                typeEnd = self._match.end(typeGroup) - self._match.start()
+                self._matchedString = (self._matchedString[:typeEnd] + templateMatch.group() +
+                        self._matchedString[typeEnd:])
 
             # Set default values.
             self._const = False
@@ -123,7 +201,7 @@ class CPPValue(object):
         return self._match.groups()
 
     def getMatchedString(self):
-        return self._match.group().strip()
+        return self._matchedString.strip()
 
     def isConst(self):
         return self._const
@@ -140,6 +218,28 @@ class CPPValue(object):
     def getType(self):
         return self._type
 
+    def getTemplateArguments(self):
+        return self._templateArguments
+
+    def isContiguousContainer(self):
+        """
+        Return True if the value is a standard container storing its
+        elements in one contiguous block of memory, i.e. a std::vector.
+        std::vector<bool> is packed and hence is not contiguous.
+        """
+        return (self._namespace == 'std' and self._type == 'vector' and
+                len(self._templateArguments) == 1 and self._templateArguments[0] != 'bool')
+
+    def isString(self):
+        """Return True if the value is a std::string, not a pointer on it."""
+        return self._namespace == 'std' and self._type == 'string' and self._pointers == 0
+
+    def getContainerElementType(self):
+        if self.isContiguousContainer():
+            return self._templateArguments[0]
+        else:
+            return None
+
     def isReference(self):
         return self._reference
 
@@ -152,6 +252,20 @@ class CPPValue(object):
     def getNumberOfPointers(self):
         return self._pointers
 
+    def getTypeString(self):
+        """Return the C++ type of the value, without its name."""
+        string = ''
+        if self._const:
+            string += 'const '
+        if self._namespace:
+            string += self._namespace + '::'
+        string += self._type
+        if self._templateArguments:
+            string += '<' + ', '.join(self._templateArguments) + '>'
+        if self._reference:
+            string += '&'
+        return string + '*' * self._pointers
+
     def getName(self):
         return self._name
 
@@ -159,6 +273,7 @@ class CPPValue(object):
         j = {'const': self.isConst(),
             'namespace': self.getNamespace(),
             'type': self.getType(),
+            'template': self.getTemplateArguments(),
             'reference': self.isReference(),
             'pointers': self.getNumberOfPointers(),
             'name': self._name}
@@ -167,6 +282,9 @@ class CPPValue(object):
     def __repr__(self):
         return self.toJSON()
 
+    def __getstate__(self):
+        return getPicklableState(self)
+
     def __str__(self):
         return self.getMatchedString()
 
@@ -178,7 +296,13 @@ class CPPValue(object):
     @staticmethod
     def getPatternWithoutGroups():
         # The group will match 'const ', don't forget to strip it.
-        return r'\s*(?:const )?\s*\w+(?:::)?(?:\w+)?\s*(?:\&)?(?:(?:\s+|\*)+)?\s*(?:\w+)?'
+        return (r'\s*(?:const )?\s*\w+(?:::)?(?:\w+)?(?:\s*<[^<>]*>)?'
+                r'\s*(?:\&)?(?:(?:\s+|\*)+)?\s*(?:\w+)?')
+
+    @staticmethod
+    def getTemplatePattern():
+        # The group matches the template arguments, without the angle brackets.
+        return r'\s*<\s*([^<>]*?)\s*>'
 
 
 class CPPMethod(object):
@@ -261,6 +385,9 @@ class CPPMethod(object):
         msg += str(self._const)
         return msg
 
+    def __getstate__(self):
+        return getPicklableState(self)
+
     @staticmethod
     def getPattern():
         return (r'\s*(' +
@@ -341,6 +468,9 @@ class CPPConstructor(object):
             msg += str(parameter) + ' '
         return msg
 
+    def __getstate__(self):
+        return getPicklableState(self)
+
     @staticmethod
     def getPattern():
         return r'\s*(\w+)\((.+)?\)'
@@ -372,11 +502,80 @@ class CPPDestructor(object):
     def __str__(self):
         return '~' + self._name
 
+    def __getstate__(self):
+        return getPicklableState(self)
+
     @staticmethod
     def getPattern():
         return r'\s*~(\w+)\(\)'
 
 
+class CPPMember(object):
+    """
+    CPPMember represents a data member of a C++ class, parsed from the line
+    declaring it, like 'unsigned int m_counts[4];'. As several members may
+    be declared by the same line, the member is the one named 'name'.
+
+    Only the members of one dimensional arrays with a literal size are
+    handled, other declarators are rejected.
+    """
+    def __init__(self, name, declarationString, public=True):
+        match = re.match(CPPMember.getPattern(), declarationString)
+        if not match:
+            raise ValueError('The given declarationString is not a valid C++ '
+                            'member declaration.')
+        declarator = re.search(r'(\*?)\s*\b' + name + r'\s*(?:\[\s*(\d+)\s*\])?\s*[,;=]',
+                declarationString[match.end(2):])
+        if not declarator:
+            raise ValueError('The member ' + name + ' is not declared by the '
+                            'given declarationString.')
+        specifiers = match.group(1).split()
+        self._name = name
+        self._type = ' '.join(match.group(2).split())
+        self._static = 'static' in specifiers
+        self._const = 'const' in specifiers
+        self._pointer = bool(declarator.group(1))
+        self._arraySize = None
+        if declarator.group(2):
+            self._arraySize = int(declarator.group(2))
+        self._public = public
+
+    def getName(self):
+        return self._name
+
+    def getType(self):
+        return self._type
+
+    def isStatic(self):
+        return self._static
+
+    def isConst(self):
+        return self._const
+
+    def isPointer(self):
+        return self._pointer
+
+    def getArraySize(self):
+        """Return the size of the array member, or None if it is not an array."""
+        return self._arraySize
+
+    def isPublic(self):
+        return self._public
+
+    def __str__(self):
+        string = self._type + ' ' + '*' * self._pointer + self._name
+        if self._arraySize is not None:
+            string += '[' + str(self._arraySize) + ']'
+        return string
+
+    @staticmethod
+    def getPattern():
+        # The first declarator ends the type, the words of the type are
+        # matched lazily so that the last word is the name of the member.
+        return (r'\s*((?:(?:static|mutable|const|volatile)\s+)*)((?:\w+::)*\w+(?:\s+\w+)*?)'
+                r'\s*\**\s*\w+\s*(?:\[[^\]]*\]\s*)?[,;=]')
+
+
 class CPPEntitiesTester(unittest.TestCase):
     """Class to unit test all the CPPEntities."""
     # Test patterns.
@@ -484,6 +683,39 @@ class CPPEntitiesTester(unittest.TestCase):
         print(value.getType())
         self.assertTrue(value.getType() == 'void')
 
+    def testCPPValueForVector(self):
+        string = 'const std::vector<double>& values'
+        value = CPPValue(string)
+        self.assertTrue(value.isReference())
+        self.assertTrue(value.getNamespace() == 'std')
+        self.assertTrue(value.getType() == 'vector')
+        self.assertTrue(value.getTemplateArguments() == ['double'])
+        self.assertTrue(value.getName() == 'values')
+        self.assertTrue(value.isContiguousContainer())
+        self.assertTrue(value.getContainerElementType() == 'double')
+        self.assertTrue(str(value) == string)
+
+    def testCPPValueTypeString(self):
+        self.assertTrue(CPPValue('const std::string** myStr').getTypeString() ==
+                'const std::string**')
+        self.assertTrue(CPPValue('std::vector<int>& values').getTypeString() ==
+                'std::vector<int>&')
+        self.assertTrue(CPPValue('int').getTypeString() == 'int')
+
+    def testCPPValueIsString(self):
+        self.assertTrue(CPPValue('const std::string& data').isString())
+        self.assertFalse(CPPValue('const std::string* data').isString())
+        self.assertFalse(CPPValue('string data').isString())
+
+    def testCPPValueForVectorOfBool(self):
+        value = CPPValue('std::vector<bool> flags')
+        self.assertFalse(value.isContiguousContainer())
+
+    def testCPPValueForNotAContainer(self):
+        value = CPPValue('const std::string& str')
+        self.assertFalse(value.isContiguousContainer())
+        self.assertTrue(value.getTemplateArguments() == [])
+
     # ----------
     # Test CPPMethod.
     def testCPPMethod(self):
@@ -491,6 +723,24 @@ class CPPEntitiesTester(unittest.TestCase):
         method = CPPMethod(string)
         self.assertTrue(method)
 
+    def testCPPMethodWithVectors(self):
+        string = 'std::vector<float> scale(const std::vector<float>& values, double factor)'
+        method = CPPMethod(string)
+        self.assertTrue(method.getReturnValue().isContiguousContainer())
+        self.assertTrue(len(method.getParameters()) == 2)
+        self.assertTrue(str(method.getParameters()[0]) == 'const std::vector<float>& values')
+        self.assertTrue(method.getParameters()[0].isContiguousContainer())
+        self.assertFalse(method.getParameters()[1].isContiguousContainer())
+
+    def testCPPMethodPickle(self):
+        string = 'const std::vector<double>& doSomething(const Object& obj, int count) const'
+        method = pickle.loads(pickle.dumps(CPPMethod(string)))
+        self.assertTrue(method.getName() == 'doSomething')
+        self.assertTrue(method.isConst())
+        self.assertTrue(str(method.getReturnValue()) == 'const std::vector<double>&')
+        self.assertTrue(len(method.getParameters()) == 2)
+        self.assertTrue(method.getMatchedGroups() == CPPMethod(string).getMatchedGroups())
+
     # ----------
     # Test CPPConstructor.
     def testCPPConstructor(self):
@@ -513,6 +763,39 @@ class CPPEntitiesTester(unittest.TestCase):
         self.assertTrue(constructor)
         self.assertTrue(constructor.isCopyConstructor())
 
+    def testCPPMemberForArray(self):
+        member = CPPMember('m_counts', '    unsigned int m_counts[4];')
+        self.assertEqual(member.getType(), 'unsigned int')
+        self.assertEqual(member.getArraySize(), 4)
+        self.assertFalse(member.isPointer())
+
+    def testCPPMemberForSeveralDeclarators(self):
+        member = CPPMember('y', 'double x, *y;')
+        self.assertEqual(member.getType(), 'double')
+        self.assertTrue(member.isPointer())
+        self.assertEqual(member.getArraySize(), None)
+
+    def testCPPClassIsPOD(self):
+        class_ = CPPClass('Point')
+        self.assertFalse(class_.isPOD())
+        class_.addMember(CPPMember('x', 'double x;'))
+        class_.addMember(CPPMember('count', 'static int count;', False))
+        class_.addMethod(CPPMethod('double length() const;'))
+        self.assertTrue(class_.isPOD())
+        class_.addConstructor(CPPConstructor('Point();'))
+        self.assertFalse(class_.isPOD())
+
+    def testCPPClassIsNotPOD(self):
+        for declaration, public in (('double x;', False), ('const double x;', True),
+                ('double* x;', True)):
+            class_ = CPPClass('Point')
+            class_.addMember(CPPMember('x', declaration, public))
+            self.assertFalse(class_.isPOD())
+        class_ = CPPClass('Point')
+        class_.addMember(CPPMember('x', 'double x;'))
+        class_.setHiddenLayout()
+        self.assertFalse(class_.isPOD())
+
     def testCPPConstructorForDestructor(self):
         string = '~Object() {}'
         constructor = None
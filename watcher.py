@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of pybindings.
+#
+# pybindings is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pybindings is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pybindings.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Watch mode of pybindings: a long running process monitoring the C++ headers
+of the current directory and updating the bindings each time one of them
+changes, without parsing the unchanged headers again.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from buildbindings import (HEADER_EXTENSIONS, TagFile, createArgumentParser,
+        createSelection, generateTags, listTaggedFiles, parseClasses, writeBindings)
+
+
+class InotifyWatcher(object):
+    """
+    Object waiting for changes of the files of a directory
+    with the Linux inotify API.
+    """
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_DELETE = 0x200
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError('inotify is not available on this system.')
+        self._directory = directory
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed.')
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        if libc.inotify_add_watch(self._fd, directory.encode(), mask) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed.')
+
+    def waitForChanges(self, timeout):
+        """
+        Wait at most 'timeout' seconds for changes and return the set
+        of the paths of the files which changed.
+        """
+        changes = set()
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return changes
+        data = os.read(self._fd, 65536)
+        offset = 0
+        # Each event is a struct inotify_event followed by the file name.
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += struct.calcsize('iIII')
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            changes.add(os.path.join(self._directory, name))
+        return changes
+
+
+class PollingWatcher(object):
+    """
+    Object waiting for changes of the files of a directory by
+    comparing their modification times periodically. This is the
+    fallback when inotify is not available.
+    """
+    def __init__(self, directory, interval=0.1):
+        self._directory = directory
+        self._interval = interval
+        self._times = self._scan()
+
+    def _scan(self):
+        times = {}
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if os.path.isfile(path):
+                times[path] = os.stat(path).st_mtime
+        return times
+
+    def waitForChanges(self, timeout):
+        """
+        Wait at most 'timeout' seconds for changes and return the set
+        of the paths of the files which changed.
+        """
+        deadline = time.time() + timeout
+        while True:
+            times = self._scan()
+            changes = set(path for path in set(times) | set(self._times)
+                    if times.get(path) != self._times.get(path))
+            self._times = times
+            if changes or time.time() >= deadline:
+                return changes
+            time.sleep(min(self._interval, max(deadline - time.time(), 0)))
+
+
+class BindingsWatcher(object):
+    """
+    Object keeping the parsed CPPClass model of the C++ headers of the current
+    directory in memory and updating the bindings when headers change.
+
+    Only the changed headers are tagged and parsed again, and only their
+    classes are rendered again, the rendering of the others being kept. The
+    bindings are then generated in memory and only the output files whose
+    content changed are written, so that the unchanged outputs keep their
+    modification time and are not rebuilt.
+    """
+    def __init__(self, options):
+        self._options = options
+        self._selection = createSelection(options)
+        # Classes parsed from each header, as lists of (CPPClass, header).
+        self._classesByHeader = {}
+        # ClassFragments of the classes of each header, by class name.
+        self._fragmentsByHeader = {}
+        # Texts of the output files written by the watcher, by path relative
+        # to the current directory.
+        self._outputs = {}
+
+    def parseAll(self):
+        """Parse all the headers of the current directory."""
+        self._classesByHeader = {}
+        self._fragmentsByHeader = {}
+        self._addClasses(generateTags(listTaggedFiles('.', self._selection)))
+        if self._selection:
+            print(self._selection.getReport())
+
+    def parseHeaders(self, headers):
+        """
+        Update the model with the classes of the list 'headers',
+        which may have been modified, created or deleted.
+        """
+        for header in headers:
+            self._classesByHeader.pop(header, None)
+            self._fragmentsByHeader.pop(header, None)
+        existingHeaders = [header for header in headers if os.path.isfile(header)]
+        if self._selection:
+            existingHeaders = self._selection.filterHeaders(existingHeaders)
+        if existingHeaders:
+            self._addClasses(generateTags(existingHeaders))
+
+    def _addClasses(self, tags):
+        classes, includes = parseClasses(TagFile(content=tags), self._selection,
+                self._options.pod_structures)
+        for class_, include in zip(classes, includes):
+            self._classesByHeader.setdefault(include, []).append((class_, include))
+
+    def writeBindings(self):
+        """
+        Write the bindings of the current model and return the list of
+        the output files which changed.
+        """
+        # Same order as the tag file of a full run, which is sorted by name.
+        classesAndIncludes = sorted((classAndInclude
+                for classesAndIncludes in self._classesByHeader.values()
+                for classAndInclude in classesAndIncludes),
+                key=lambda classAndInclude: classAndInclude[0].getName())
+        classes = [class_ for class_, include in classesAndIncludes]
+        includes = [include for class_, include in classesAndIncludes]
+
+        renderedFragments = {}
+        for fragmentsByName in self._fragmentsByHeader.values():
+            renderedFragments.update(fragmentsByName)
+        files = writeBindings(classes, includes, self._options, inMemory=True,
+                renderedFragments=renderedFragments)
+        self._fragmentsByHeader = {}
+        for class_, include in classesAndIncludes:
+            self._fragmentsByHeader.setdefault(include, {})[class_.getName()] = \
+                    renderedFragments[class_.getName()]
+
+        outputs = dict((os.path.normpath(filename), text) for filename, text in files.items())
+        changed = []
+        for output in sorted(outputs):
+            if not self._sameContent(outputs[output], output):
+                if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+                    os.makedirs(os.path.dirname(output))
+                with open(output, 'w') as fp:
+                    fp.write(outputs[output])
+                changed.append(output)
+        # Remove the outputs of the classes which do not exist anymore.
+        for output in sorted(set(self._outputs) - set(outputs)):
+            if os.path.isfile(output):
+                os.remove(output)
+                changed.append(output)
+        self._outputs = outputs
+        return changed
+
+    def _sameContent(self, text, path):
+        # The outputs written before are not read again.
+        if not os.path.isfile(path):
+            return False
+        if path in self._outputs:
+            return self._outputs[path] == text
+        with open(path) as fp:
+            return fp.read() == text
+
+    def isWatchedHeader(self, path):
+        """
+        Return True if the file 'path' is a C++ header of the bindings,
+        and not one of the outputs of the watcher itself.
+        """
+        path = os.path.relpath(path)
+        if self._selection and not self._selection.isHeaderSelected(path):
+            return False
+        return path.endswith(HEADER_EXTENSIONS) and path not in self._outputs
+
+    def watch(self, fileWatcher, debounce=0.02):
+        """
+        Update the bindings each time a header watched by 'fileWatcher' changes,
+        until the process is interrupted. Changes happening within 'debounce'
+        seconds are handled together, since editors often write files in
+        several steps.
+        """
+        print('Watching the headers for changes, press Ctrl+C to stop.')
+        while True:
+            changes = fileWatcher.waitForChanges(1.0)
+            if not changes:
+                continue
+            begin = time.time()
+            moreChanges = fileWatcher.waitForChanges(debounce)
+            while moreChanges:
+                changes |= moreChanges
+                moreChanges = fileWatcher.waitForChanges(debounce)
+            headers = sorted(set(os.path.relpath(path) for path in changes
+                    if self.isWatchedHeader(path)))
+            if not headers:
+                continue
+            self.parseHeaders(headers)
+            changed = self.writeBindings()
+            print('Bindings updated in %.1f ms after changes of %s. Changed outputs: %s' %
+                    (1000 * (time.time() - begin), ', '.join(headers),
+                    ', '.join(changed) if changed else 'none'))
+
+
+def main(argv=None):
+    parser = createArgumentParser('Watch the C++ headers of the current directory '
+            'and update the Python bindings each time they change.')
+    parser.add_argument('--polling', action='store_true',
+            help='poll the modification times of the headers instead of using inotify')
+    parser.add_argument('--interval', type=float, default=0.1,
+            help='polling interval in seconds')
+    options = parser.parse_args(argv)
+
+    watcher = BindingsWatcher(options)
+    watcher.parseAll()
+    watcher.writeBindings()
+
+    fileWatcher = None
+    if not options.polling:
+        try:
+            fileWatcher = InotifyWatcher(os.getcwd())
+        except (OSError, AttributeError):
+            print('inotify is not available, falling back to polling.')
+    if fileWatcher is None:
+        fileWatcher = PollingWatcher(os.getcwd(), options.interval)
+    try:
+        watcher.watch(fileWatcher)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -15,8 +15,11 @@
 # 
 # You should have received a copy of the GNU General Public License
 # along with pybindings.  If not, see <http://www.gnu.org/licenses/>.
+import fnmatch
+import multiprocessing
 import os
 import platform
+import re
 
 
 class PyAPIWriter(object):
@@ -29,7 +32,11 @@ class PyAPIWriter(object):
     does not ensure that the code work properly, it only ensures that it
     can be executed.
     """
-    def __init__(self, filename, includes, libraryName):
+    def __init__(self, filename, includes, libraryName, accounting=False,
+            stressHarness=False, perClassModules=False, jobs=1, commandBuffer=False,
+            memoize=0, pickling=False, threadSafe=False, inMemory=False,
+            precompiledHeader=False, dispatchTable=False, identityMap=False,
+            sharedHandles=False, podStructures=False, ownedResults=None):
         """
         - filename is the core of the names of the files, without extension, to
         which the PyAPIWriter will write text. For instance, this could be 'myproject'.
@@ -38,70 +45,390 @@ class PyAPIWriter(object):
         - includes is the list of header files that must be included in the C API header.
         - libraryName is the shared library of dll that will contain
         the bindings and hence that will be loaded by 'myproject.py'.
+        - accounting enables the live native object accounting: the C API then
+        counts the live instances and allocated bytes of each class and the
+        Python wrapper exposes a snapshot of these counters.
+        - stressHarness enables the generation of 'myproject_stress.py', a
+        harness running every bound method from several threads and processes
+        to measure how it scales and detect crashes and data races.
+        - perClassModules writes the Python wrapper as a package 'myproject'
+        with one module per class. The package '__init__.py' only loads the
+        library and imports the class modules on first access, so that
+        importing the wrapper of a huge API stays cheap.
+        - jobs is the number of processes rendering the classes concurrently.
+        The output does not depend on it.
+        - commandBuffer enables the command buffer: the Python wrapper can
+        record a sequence of method calls and the C API executes all of them
+        with a single call of pybindings_execute.
+        - memoize is the number of results of zero-argument const methods
+        returning values cached by each Python wrapper object, 0 disabling
+        the memoization, see isMemoized.
+        Calling a non-const method of the object drops its cache.
+        - pickling makes the Python wrapper objects picklable, through the
+        'serialize() const' and 'deserialize(const std::string&)' methods of
+        the classes declaring them. The other classes can only be copied with
+        the copy module, through their copy constructor.
+        - threadSafe makes the C API lock the objects, so that they can be used
+        from several threads: the const methods take a shared lock on their
+        object and the other methods an exclusive one. Since ctypes releases
+        the GIL during the native calls, the threads working on different
+        objects, or reading the same one, run concurrently.
+        - inMemory keeps the generated files in memory instead of writing them
+        to the disk. They are then returned by getOutputs.
+        - precompiledHeader writes the includes of the C API implementation to
+        'myproject_pch.h', included first by 'myproject.cpp', so that it can
+        be precompiled once and reused until the C++ headers change.
+        - dispatchTable makes the library export a single function,
+        pybindings_table, returning the table of the addresses of all the
+        functions of the C API. The other functions are hidden and the Python
+        wrapper builds all its typed ctypes functions from the table at import,
+        instead of looking up each symbol by name.
+        - identityMap makes the methods returning a pointer or a reference to
+        an object of a wrapped class return its Python wrapper instead of its
+        address. The wrappers are kept in a weak-valued map by address, so that
+        an object returned several times is always wrapped by the same Python
+        object and is never deleted twice. The returned objects are borrowed
+        from the object the method was called on, unless the method matches
+        one of the ownedResults patterns.
+        - sharedHandles counts the owners of the objects in the C API, so that
+        several handles can share an object without copying it: the function
+        <className>_share adds an owner and <className>_delete only deletes
+        the object when its last owner releases it. The Python wrappers get a
+        share() method returning a new wrapper of the same object, whose
+        memoized results are dropped with the ones of the other wrappers.
+        - podStructures wraps the plain old data classes, see CPPClass.isPOD,
+        with ctypes structures of the same layout instead of handles on heap
+        objects: their fields are read and written without calling the C API,
+        they are passed by value to the methods of the other classes and the
+        vectors of them are exchanged as NumPy structured arrays. The layouts
+        are taken from the library and checked when the wrapper is imported.
+        - ownedResults is the list of the glob patterns of the methods whose
+        returned pointer is owned by the caller, like 'Stuff.clone' or
+        'create*', see isResultOwned. With identityMap, the wrappers of these
+        objects delete them, and the accounting counts them as created.
         """
         self._headerFilename = filename + '.h'
         self._implementationFilename = filename + '.cpp'
         self._wrapperFilename = filename + '.py'
+        self._stressHarnessFilename = filename + '_stress.py'
+        self._precompiledHeaderFilename = None
+        if precompiledHeader:
+            self._precompiledHeaderFilename = filename + '_pch.h'
         self._includes = includes
         self._libraryName = libraryName
+        self._jobs = jobs
 
-        # The unit tests are first written to a temporary file before being
-        # concatenated in the main Python wrapper file.
-        self._testerFilename = '__tester'
+        # Texts of the files generated in memory, as lists of chunks
+        # by file name, or None if the files are written to the disk.
+        self._outputs = {} if inMemory else None
 
-        # Counter of the number of constructors written to the C API files.
-        self._writtenConstructors = 0
+        # The following attributes gather the data of the ClassFragments
+        # of the rendered classes, in the order of the classes.
 
-    def writeClasses(self, classes):
+        # Names of the classes whose instances are counted in the C API.
+        self._accounting = accounting
+        self._accountedClasses = []
+
+        # Methods exercised by the stress harness, as tuples
+        # (className, methodName, arguments, compareResults) where arguments
+        # is the Python source of the arguments tuple or None if the method
+        # cannot be called with default arguments, and compareResults tells
+        # if the method returns a value, not an address specific to each object
+        # or an array, whose comparison is ambiguous.
+        self._stressHarness = stressHarness
+        self._stressMethods = []
+
+        # Element types of the vectors returned by value, which need a
+        # deletion function in the C API.
+        self._usesContainers = False
+        self._vectorElementTypes = set()
+
+        # Functions of the dispatch table, as tuples (name, restype, argtypes) of
+        # the function name and of the Python sources of its ctypes prototype,
+        # see getTableFunctions.
+        self._dispatchTable = dispatchTable
+        self._tableFunctions = []
+
+        # Names of the wrapped classes, whose objects returned by the methods
+        # are wrapped with the identity map.
+        self._identityMap = identityMap
+        self._classNames = set()
+        self._ownedResults = ownedResults or []
+
+        # Names of the plain old data classes wrapped as ctypes structures,
+        # see isStructureClass.
+        self._podStructures = podStructures
+        self._structureClasses = set()
+
+        # Standard headers and names of the classes declared by the C API
+        # header instead of including the C++ headers, see getForwardDeclarations.
+        self._forwardDeclarations = None
+
+        # Methods which can be recorded in the command buffer, as tuples
+        # (className, methodName, argumentSlots, resultSlot, mutating, statement), see
+        # getCommand. The opcode of a method is its index in this list.
+        self._commandBuffer = commandBuffer
+        self._commands = []
+
+        self._memoize = memoize
+        self._pickling = pickling
+        self._threadSafe = threadSafe
+        self._sharedHandles = sharedHandles
+
+        # With the per class layout, the wrapper is a package and
+        # self._wrapperFilename is the module currently written.
+        self._wrapperPackage = None
+        self._wrappedClasses = []
+        if perClassModules:
+            self._wrapperPackage = filename
+            self._wrapperFilename = os.path.join(filename, '__init__.py')
+
+    def writeClasses(self, classes, renderedFragments=None):
         """
         Main method of the class. Writes both the pure C API and the Python
         wrapper of the CPPClass collection 'classes' to the files.
+
+        The ClassFragments of the dictionary 'renderedFragments', by class
+        name, are reused instead of rendering the classes again, and the
+        dictionary is updated with the classes rendered, see renderClasses.
         """
         print('PyAPIWriter: start writing classes...')
+        if self._podStructures:
+            self._structureClasses = set(class_.getName() for class_ in classes
+                    if self.isStructureClass(class_))
+            # The structures are defined first, since the prototypes of the
+            # methods of the other classes refer to them.
+            classes = ([class_ for class_ in classes if class_.getName() in self._structureClasses] +
+                    [class_ for class_ in classes if class_.getName() not in self._structureClasses])
+        self._usesContainers = any(self.usesContainers(method)
+                for class_ in classes for method in class_.getMethods())
+        self._forwardDeclarations = self.getForwardDeclarations(classes)
+        self._classNames = set(class_.getName() for class_ in classes)
+        if renderedFragments is None:
+            allFragments = self.renderClasses(classes)
+        else:
+            allFragments = self.updateFragments(classes, renderedFragments)
+        for fragments in allFragments:
+            self._gatherClass(fragments)
+        if self._dispatchTable:
+            self._tableFunctions = self.getTableFunctions(allFragments)
         self.initializeDeclaration()
         self.initializeImplementation()
         self.initializeWrapper()
-        for class_ in classes:
-            self._writeClass(class_)
+        for fragments in allFragments:
+            self._mergeClass(fragments)
         self.finalizeDeclaration()
-        self.finalizeWrapper()
+        self.finalizeImplementation()
+        if self._wrapperPackage:
+            self.finalizeWrapperPackage()
+        else:
+            self.finalizeWrapper()
+        if self._stressHarness:
+            self.writeStressHarness()
 
-    def _writeClass(self, class_):
+    def renderClasses(self, classes):
         """
-        Writes the CPPClass 'class_' to the file in a C format and
-        its corresponding Python wrapper. This method is for internal
-        use (somehow private).
+        Render the CPPClass collection 'classes' and return the list of their
+        ClassFragments, in the same order. The classes are rendered by a pool
+        of processes when more than one job was requested.
         """
-        print("Writing class '" + class_.getName() +
-            "' to files " + self._headerFilename +
-            ", " + self._implementationFilename +
-            " and " + self._wrapperFilename + ":")
+        if self._jobs <= 1 or len(classes) <= 1:
+            return [self.renderClass(class_) for class_ in classes]
+        print('PyAPIWriter: rendering classes with ' + str(self._jobs) + ' processes...')
+        # The writer and the classes are given once to each worker, which is
+        # free when the workers are forked, and only the class indices are
+        # sent with the tasks. Pickling the classes costs more than rendering them.
+        pool = multiprocessing.Pool(self._jobs, _initializeRenderWorker, (self, classes))
+        try:
+            chunkSize = max(1, len(classes) // (4 * self._jobs))
+            return pool.map(_renderClassAt, range(len(classes)), chunkSize)
+        finally:
+            pool.close()
+            pool.join()
+
+    def updateFragments(self, classes, renderedFragments):
+        """
+        Return the list of the ClassFragments of the CPPClass collection
+        'classes', taken from the dictionary 'renderedFragments', by class
+        name, when they were rendered in the same context, see
+        getRenderingContext. The other classes are rendered and stored in the
+        dictionary. The caller must drop the fragments of the modified classes.
+        """
+        context = self.getRenderingContext()
+        outdated = [class_ for class_ in classes
+                if class_.getName() not in renderedFragments or
+                renderedFragments[class_.getName()].context != context]
+        for fragments in self.renderClasses(outdated):
+            renderedFragments[fragments.className] = fragments
+        return [renderedFragments[class_.getName()] for class_ in classes]
+
+    def getRenderingContext(self):
+        """
+        Return the data common to all the classes which the rendering of a
+        class depends on, besides the class itself and the options.
+        """
+        return (frozenset(self._classNames), frozenset(self._structureClasses))
+
+    def renderClass(self, class_):
+        """
+        Render the CPPClass 'class_' in a C format and its corresponding
+        Python wrapper, and return the corresponding ClassFragments.
+
+        The result only depends on 'class_' and on the options of the writer,
+        so that the classes can be rendered in any order or concurrently.
+        """
+        print("Rendering class '" + class_.getName() + "':")
+        fragments = ClassFragments(class_.getName())
+        fragments.context = self.getRenderingContext()
 
         # First initialize the class implementation of the Python wrapper and of
         # its corresponding unit test class.
-        with open(self._wrapperFilename, 'a') as fp:
-            fp.write('class ' + class_.getName() + '(object):\n')
-        with open(self._testerFilename, 'a') as fp:
-            fp.write('class ' + class_.getName() + 'Tester(unittest.TestCase):\n')
+        structure = class_.getName() in self._structureClasses
+        if structure:
+            fragments.wrapper += 'class ' + class_.getName() + '(ctypes.Structure):\n'
+        else:
+            fragments.wrapper += 'class ' + class_.getName() + '(object):\n'
+        if self._identityMap and not structure:
+            fragments.wrapper += (self.indent() + '# False for the wrappers of objects owned by '
+                    'another object, see _wrapPointer.\n' +
+                    self.indent() + '_owned = True\n\n' +
+                    self.indent() + '@property\n' +
+                    self.indent() + 'def _as_parameter_(self):\n' +
+                    self.indent(2) + '"""Let the wrapper be passed to the C API functions."""\n' +
+                    self.indent(2) + 'return self._obj\n\n')
+        fragments.tester += 'class ' + class_.getName() + 'Tester(unittest.TestCase):\n'
+
+        # The structures are not allocated by the C API.
+        if structure:
+            self.writeStructure(fragments, class_)
+        elif self._accounting:
+            self.writeClassAccounting(fragments, class_)
 
         for constructor in class_.getConstructors():
-            self.writeConstructor(constructor)
+            self.writeConstructor(fragments, constructor)
 
         if class_.hasDestructor():
-            self.writeDestructor(class_.getDestructor())
+            self.writeDestructor(fragments, class_.getDestructor())
+            if self._sharedHandles:
+                self.writeShare(fragments, class_)
+
+        # The ctypes structures are picklable by themselves.
+        if self._pickling and not structure:
+            self.writeSerialization(fragments, class_)
 
         if class_.hasMethods():
-            self.addBlankLine(self._headerFilename)
+            fragments.declaration += '\n'
             for method in class_.getMethods():
-                self.writeMethod(class_.getName(), method)
+                self.writeMethod(fragments, class_.getName(), method)
 
-        # The class is totally implemented, now retrieve the unit tests that are
-        # in the temporary file and put them in the wrapper file.
-        self.concatenateTesterClass()
+        # A class without anything to bind still needs a body.
+        if fragments.wrapper.endswith(':\n'):
+            fragments.wrapper += self.indent() + 'pass\n\n'
+        if fragments.tester.endswith(':\n'):
+            fragments.tester += self.indent() + 'pass\n\n'
+        return fragments
+
+    def getOutputs(self):
+        """
+        Return the dictionary of the texts of the files generated in memory,
+        by file name.
+        """
+        return dict((filename, ''.join(chunks))
+                for filename, chunks in self._outputs.items())
+
+    def _openOutput(self, filename, mode):
+        """
+        Open the output file 'filename' for writing ('w') or appending ('a'),
+        in memory if the files are generated in memory.
+        This method is for internal use (somehow private).
+        """
+        if self._outputs is None:
+            return open(filename, mode)
+        if mode == 'w' or filename not in self._outputs:
+            self._outputs[filename] = []
+        return _OutputFile(self._outputs[filename])
+
+    def _mergeClass(self, fragments):
+        """
+        Append the ClassFragments 'fragments' of a rendered class to the files.
+        This method is for internal use (somehow private).
+        """
+        if self._wrapperPackage:
+            self.initializeClassModule(fragments.className, fragments.structureTypes)
+
+        print("Writing class '" + fragments.className +
+            "' to files " + self._headerFilename +
+            ", " + self._implementationFilename +
+            " and " + self._wrapperFilename + ".")
+
+        with self._openOutput(self._headerFilename, 'a') as fp:
+            fp.write(fragments.declaration)
+        with self._openOutput(self._implementationFilename, 'a') as fp:
+            fp.write(fragments.implementation)
+        with self._openOutput(self._wrapperFilename, 'a') as fp:
+            fp.write(fragments.wrapper)
+            if fragments.prototypes:
+                fp.write('\n' + fragments.prototypes)
+            # The class is totally implemented, now add its unit tests.
+            fp.write('\n' + fragments.tester)
+        if self._wrapperPackage:
+            self.finalizeWrapper()
+
+    def _gatherClass(self, fragments):
+        """
+        Gather the data of the ClassFragments 'fragments' of a rendered class
+        needed by the parts of the files common to all the classes.
+        This method is for internal use (somehow private).
+        """
+        if self._accounting and fragments.className not in self._structureClasses:
+            self._accountedClasses.append(fragments.className)
+        self._stressMethods.extend(fragments.stressMethods)
+        self._vectorElementTypes.update(fragments.vectorElementTypes)
+        self._commands.extend(fragments.commands)
+
+    def getForwardDeclarations(self, classes):
+        """
+        Return the tuple (standardHeaders, classNames) of the standard headers
+        and of the names of the classes the C API header needs to declare the
+        functions of the CPPClass collection 'classes', or None if some types
+        of the functions can only be declared by including the C++ headers.
+
+        Including the C++ headers in the C API header makes every unit using
+        the C API parse the whole C++ project, while the functions only
+        handle the objects through pointers, for which a forward declaration
+        of their class is enough.
+        """
+        classNames = set(class_.getName() for class_ in classes)
+        standardHeaders = set()
+        for class_ in classes:
+            if '::' in class_.getName():
+                return None
+            values = []
+            for constructor in class_.getConstructors():
+                values.extend(constructor.getParameters())
+            for method in class_.getMethods():
+                values.append(method.getReturnValue())
+                values.extend(method.getParameters())
+            for value in values:
+                typeNames = [value.getType()]
+                if value.hasNamespace():
+                    typeNames[0] = value.getNamespace() + '::' + value.getType()
+                for argument in value.getTemplateArguments():
+                    typeNames.extend(re.findall(r'[A-Za-z_][\w:]*', argument))
+                for typeName in typeNames:
+                    if typeName in DECLARATION_HEADERS:
+                        standardHeaders.add(DECLARATION_HEADERS[typeName])
+                    elif typeName not in BUILTIN_TYPES and typeName not in classNames:
+                        return None
+        return sorted(standardHeaders), sorted(classNames)
+
+    def getIncludes(self):
+        """Return the C++ headers of the classes, in alphabetical order."""
+        return sorted(set(self._includes))
 
     def initializeDeclaration(self):
         """Add its header to the C API header file."""
-        with open(self._headerFilename, 'w') as fp:
+        with self._openOutput(self._headerFilename, 'w') as fp:
             header = ('/* File automatically generated by the pybindings project.\n'
                     'This file declare a pure C API for the C++ objects.\n'
                     'The following macros allow to export the symbols from the ')
@@ -119,26 +446,244 @@ class PyAPIWriter(object):
                         '#else\n'
                         '#define PYBINDING_API\n'
                         '#endif\n\n')
-            fp.write(header)
+            if self._dispatchTable:
+                # Only the table is exported, the functions are reached through it.
+                header = header.replace('PYBINDING_API', 'PYBINDING_TABLE_API')
+                if platform.system() == 'Windows':
+                    header += '#define PYBINDING_API\n\n'
+                else:
+                    header += '#define PYBINDING_API __attribute__((visibility("hidden")))\n\n'
+            # The header is included both by the precompiled header and the
+            # implementation.
+            fp.write('#ifndef ' + self.getIncludeGuard() + '\n' +
+                    '#define ' + self.getIncludeGuard() + '\n\n' + header)
+
+            # The containers are passed with their size as a size_t, which is
+            # also the type of the layouts of the structures.
+            if self._usesContainers or self._structureClasses:
+                fp.write('#include <stddef.h>\n')
+            # The integers of the command buffer are int64_t, since long long
+            # is not ISO C++ 1998.
+            if self._commandBuffer:
+                fp.write('#include <stdint.h>\n')
 
-            # Add the includes in alphabetical order.
-            for include in sorted(self._includes):
-                fp.write('#include "' + include + '"\n')
+            if self._forwardDeclarations:
+                # The functions only handle the objects through pointers, so
+                # the C++ headers are included by the implementation only.
+                standardHeaders, classNames = self._forwardDeclarations
+                for standardHeader in standardHeaders:
+                    fp.write('#include ' + standardHeader + '\n')
+                fp.write('\n')
+                for className in classNames:
+                    fp.write('class ' + className + ';\n')
+            else:
+                # Add the includes in alphabetical order.
+                for include in self.getIncludes():
+                    fp.write('#include "' + include + '"\n')
             fp.write('\nextern "C"\n'
                     '{\n')
 
+            fp.write(self.getInitialDeclaration())
+
+    def getInitialDeclaration(self):
+        """
+        Return the declarations of the C API header preceding the ones of
+        the classes.
+        """
+        declaration = ''
+        if self._accounting:
+            declaration += (self.indent() + '/* Live native object accounting. */\n' +
+                    self.indent() + 'typedef struct PyBindingsStats\n' +
+                    self.indent() + '{\n' +
+                    self.indent(2) + 'const char* className;\n' +
+                    self.indent(2) + 'long liveInstances;\n' +
+                    self.indent(2) + 'long allocatedBytes;\n' +
+                    self.indent(2) + 'long highWaterInstances;\n' +
+                    self.indent(2) + 'long highWaterBytes;\n' +
+                    self.indent() + '} PyBindingsStats;\n\n' +
+                    self.indent() + 'PYBINDING_API int pybindings_stats_count();\n' +
+                    self.indent() + 'PYBINDING_API int pybindings_stats_snapshot('
+                    'PyBindingsStats* stats, int capacity);\n' +
+                    self.indent() + 'PYBINDING_API void pybindings_stats_total('
+                    'PyBindingsStats* stats);\n' +
+                    self.indent() + 'PYBINDING_API void pybindings_stats_reset_high_water();\n\n')
+        return declaration
+
     def finalizeDeclaration(self):
         """Finalize the file by closing braces etc."""
-        with open(self._headerFilename, 'a') as fp:
-            fp.write('}\n\n')
+        with self._openOutput(self._headerFilename, 'a') as fp:
+            fp.write(self.getFinalDeclaration())
+            if self._dispatchTable:
+                fp.write('\n' + self.indent() + '/* Table of the functions above, in order. */\n' +
+                        self.indent() + 'typedef void (*PyBindingsFunction)(void);\n\n' +
+                        self.indent() + 'typedef struct PyBindingsTable\n' +
+                        self.indent() + '{\n' +
+                        self.indent(2) + 'int count;\n' +
+                        self.indent(2) + 'const PyBindingsFunction* functions;\n' +
+                        self.indent() + '} PyBindingsTable;\n\n' +
+                        self.indent() + 'PYBINDING_TABLE_API const PyBindingsTable* '
+                        'pybindings_table();\n')
+            fp.write('}\n\n'
+                    '#endif /* ' + self.getIncludeGuard() + ' */\n')
+
+    def getFinalDeclaration(self):
+        """
+        Return the declarations of the C API header following the ones of
+        the classes.
+        """
+        declaration = ''
+        if self._vectorElementTypes:
+            declaration += '\n'
+        for elementType in sorted(self._vectorElementTypes):
+            declaration += (self.indent() + 'PYBINDING_API void pybindings_vector_' +
+                    elementType + '_delete(void* vector);\n')
+        if self._commandBuffer:
+            declaration += ('\n' + self.indent() + '/* Command buffer. */\n' +
+                    self.indent() + 'typedef union PyBindingsSlot\n' +
+                    self.indent() + '{\n' +
+                    self.indent(2) + 'int64_t integer;\n' +
+                    self.indent(2) + 'double real;\n' +
+                    self.indent(2) + 'void* pointer;\n' +
+                    self.indent() + '} PyBindingsSlot;\n\n' +
+                    self.indent() + 'typedef struct PyBindingsCommand\n' +
+                    self.indent() + '{\n' +
+                    self.indent(2) + 'int opcode;\n' +
+                    self.indent(2) + 'void* object;\n' +
+                    self.indent(2) + 'PyBindingsSlot arguments[' +
+                    str(self.getCommandArgumentCount()) + '];\n' +
+                    self.indent(2) + 'PyBindingsSlot result;\n' +
+                    self.indent() + '} PyBindingsCommand;\n\n' +
+                    self.indent() + 'PYBINDING_API int pybindings_execute('
+                    'PyBindingsCommand* commands, int count);\n')
+        return declaration
+
+    def getTableFunctions(self, allFragments):
+        """
+        Return the functions of the dispatch table, in the order of their
+        declarations in the C API header, as tuples (name, restype, argtypes)
+        of the function name and of the Python sources of its ctypes
+        prototype. argtypes is None if some parameters of the function have no
+        ctypes equivalent, they are then converted by ctypes from the arguments.
+        restype is ctypes.c_int, the ctypes default, if the result has none.
+        """
+        declarations = (self.getInitialDeclaration() +
+                ''.join(fragments.declaration for fragments in allFragments) +
+                self.getFinalDeclaration())
+        functions = []
+        for returnType, name, parameters in re.findall(
+                r'PYBINDING_API (.+?)\b(\w+)\((.*)\);', declarations):
+            restype = self.getFunctionCType(returnType)
+            argtypes = [self.getFunctionCType(parameter, True)
+                    for parameter in self.splitParameters(parameters)]
+            if restype is None:
+                functions.append((name, 'ctypes.c_int', None))
+            elif None in argtypes:
+                # The result, like a pointer, must still not be truncated.
+                functions.append((name, restype, None))
+            else:
+                functions.append((name, restype, '(' + ', '.join(argtypes) +
+                        (',' if len(argtypes) == 1 else '') + ')'))
+        return functions
+
+    def splitParameters(self, parameters):
+        """
+        Return the list of the parameters of the string 'parameters' of the
+        parameters of a C function, which are separated by commas outside of
+        template arguments.
+        """
+        result = []
+        depth = 0
+        current = ''
+        for character in parameters:
+            if character == ',' and depth == 0:
+                result.append(current.strip())
+                current = ''
+                continue
+            if character == '<':
+                depth += 1
+            elif character == '>':
+                depth -= 1
+            current += character
+        if current.strip() and current.strip() != 'void':
+            result.append(current.strip())
+        return result
+
+    def getFunctionCType(self, declaration, named=False, structures=False):
+        """
+        Return the Python source of the ctypes type of the C type of the
+        string 'declaration', followed by the name of the parameter if 'named',
+        or None if the type has no ctypes equivalent. The structures (see
+        isStructureClass) have one if 'structures', but it is only defined
+        with the classes, as well as the pointers and references to them.
+        """
+        indirections = declaration.count('*') + declaration.count('&')
+        words = [word for word in re.split(r'[\s*&]+', declaration) if word and word != 'const']
+        if named and len(words) > 1 and words[-1] not in FUNCTION_CTYPES_WORDS:
+            words = words[:-1]
+        if structures and ' '.join(words) in self._structureClasses:
+            if indirections == 0:
+                return ' '.join(words)
+            if indirections == 1:
+                return 'ctypes.POINTER(' + ' '.join(words) + ')'
+        if indirections:
+            return 'ctypes.c_void_p'
+        return FUNCTION_CTYPES.get(' '.join(words))
+
+    def getPrototype(self, functionName, cReturn, cParameters):
+        """
+        Return the Python code setting the ctypes prototype of the C API
+        function 'functionName' returning the C type 'cReturn' and taking the
+        list of C parameter declarations 'cParameters'. Without it, ctypes
+        truncates the pointers to ints. The result type is only set if it is
+        not the default int, and the parameter types if they all have a ctypes
+        equivalent, see getFunctionCType.
+
+        The functions of the dispatch table already have their prototype,
+        except for the structures, which are defined after the table.
+        """
+        # The addresses of structures are returned as ints, like the others.
+        restype = self.getFunctionCType(cReturn,
+                structures='*' not in cReturn and '&' not in cReturn)
+        argtypes = [self.getFunctionCType(parameter, True, True) for parameter in cParameters]
+        if self._dispatchTable and (restype == self.getFunctionCType(cReturn) and argtypes ==
+                [self.getFunctionCType(parameter, True) for parameter in cParameters]):
+            return ''
+        prototype = ''
+        if restype not in (None, 'None', 'ctypes.c_int'):
+            prototype += 'LIB.' + functionName + '.restype = ' + restype + '\n'
+        if None not in argtypes:
+            prototype += ('LIB.' + functionName + '.argtypes = (' + ', '.join(argtypes) +
+                    (',' if len(argtypes) == 1 else '') + ')\n')
+        return prototype
+
+    def getIncludeGuard(self):
+        """Return the name of the macro guarding the C API header."""
+        return re.sub(r'\W', '_', os.path.basename(self._headerFilename)).upper() + '_'
 
     def initializeImplementation(self):
         """Add its header to the C API implementation file."""
-        with open(self._implementationFilename, 'w') as fp:
+        includes = '#include "' + self._headerFilename + '"\n'
+        if self._forwardDeclarations:
+            for include in self.getIncludes():
+                includes += '#include "' + include + '"\n'
+        includes += '\n#include <iostream>\n'
+        if self._usesContainers:
+            includes += ('#include <algorithm>\n'
+                    '#include <vector>\n')
+        if self._pickling:
+            includes += '#include <cstring>\n'
+        if self._precompiledHeaderFilename:
+            with self._openOutput(self._precompiledHeaderFilename, 'w') as fp:
+                fp.write('/* File automatically generated by the pybindings project.\n' +
+                        'This file includes the headers of the C API implementation, so that\n'
+                        'they can be precompiled. */\n' + includes)
+            includes = ('#include "' + os.path.basename(self._precompiledHeaderFilename) +
+                    '"\n')
+        with self._openOutput(self._implementationFilename, 'w') as fp:
             fp.write('/* File automatically generated by the pybindings project.\n' +
                     'This file implements a pure C API for the C++ objects. */\n' +
-                    '#include "' + self._headerFilename + '"\n\n' +
-                    '#include <iostream>\n\n' +
+                    includes +
+                    '\n' +
                     'static void nullObjectError(const char* functionName)\n' +
                     '{\n' +
                     self.indent() + 'std::string message("*** ERROR ***\\n"\n' +
@@ -147,14 +692,249 @@ class PyAPIWriter(object):
                     self.indent() + 'std::cout << message.c_str() << std::endl;\n' +
                     '}\n\n')
 
+            # The numbers of owners of the shared objects are protected by
+            # the locks of the objects.
+            if self._threadSafe or self._sharedHandles:
+                fp.write(self.getLockImplementation())
+            if self._sharedHandles:
+                fp.write(self.getShareImplementation())
+            if self._accounting:
+                fp.write(self.getAccountingImplementation())
+
+    def getTableImplementation(self):
+        """Return the C++ code of the dispatch table and of pybindings_table."""
+        # The table ends with a null entry, so that it is never empty.
+        return ('static const PyBindingsFunction pybindingsFunctions[] =\n'
+                '{\n' +
+                ''.join(self.indent() + 'reinterpret_cast<PyBindingsFunction>(' + name + '),\n'
+                        for name, restype, argtypes in self._tableFunctions) +
+                self.indent() + '0\n'
+                '};\n\n'
+                'static const PyBindingsTable pybindingsTable = {' +
+                str(len(self._tableFunctions)) + ', pybindingsFunctions};\n\n'
+                'const PyBindingsTable* pybindings_table()\n'
+                '{\n' +
+                self.indent() + 'return &pybindingsTable;\n'
+                '}\n\n')
+
+    def getLockImplementation(self):
+        """
+        Return the C++ code of the reader/writer locks of the objects.
+
+        The C API only handles raw pointers, so the locks cannot be stored in
+        the objects: each object is mapped to one of a fixed set of locks by its
+        address. Two objects sharing a lock only delay each other. The locks are
+        padded to avoid sharing cache lines between them.
+        """
+        lockCount = 256
+        if platform.system() == 'Windows':
+            lockType = 'SRWLOCK'
+            initializer = 'SRWLOCK_INIT'
+            header = WINDOWS_INCLUDE
+            lockShared = 'AcquireSRWLockShared(&lock.lock)'
+            lockExclusive = 'AcquireSRWLockExclusive(&lock.lock)'
+            unlockShared = 'ReleaseSRWLockShared(&lock.lock)'
+            unlockExclusive = 'ReleaseSRWLockExclusive(&lock.lock)'
+        else:
+            lockType = 'pthread_rwlock_t'
+            initializer = 'PTHREAD_RWLOCK_INITIALIZER'
+            header = '#include <pthread.h>\n'
+            lockShared = 'pthread_rwlock_rdlock(&lock.lock)'
+            lockExclusive = 'pthread_rwlock_wrlock(&lock.lock)'
+            unlockShared = unlockExclusive = 'pthread_rwlock_unlock(&lock.lock)'
+        initializers = ', '.join(['{' + initializer + '}'] * lockCount)
+        return ('/* Reader/writer locks of the objects. */\n' +
+                header +
+                '#include <cstddef>\n\n'
+                'union PyBindingsLock\n'
+                '{\n' +
+                self.indent() + lockType + ' lock;\n' +
+                self.indent() + 'char padding[128];\n'
+                '};\n\n'
+                'static PyBindingsLock pybindingsLocks[' + str(lockCount) + '] = {' +
+                initializers + '};\n\n'
+                '/* Index of the lock of an object. */\n'
+                'static size_t pybindingsStripe(const void* obj)\n'
+                '{\n' +
+                self.indent() + 'return (reinterpret_cast<size_t>(obj) >> 4) % ' + str(lockCount) + ';\n'
+                '}\n\n'
+                'class PyBindingsGuard\n'
+                '{\n'
+                'public:\n' +
+                self.indent() + 'PyBindingsGuard(const void* obj, bool exclusive)\n' +
+                self.indent(2) + ': lock(pybindingsLocks[pybindingsStripe(obj)]), exclusive(exclusive)\n' +
+                self.indent() + '{\n' +
+                self.indent(2) + 'if(exclusive) ' + lockExclusive + '; else ' + lockShared + ';\n' +
+                self.indent() + '}\n\n' +
+                self.indent() + '~PyBindingsGuard()\n' +
+                self.indent() + '{\n' +
+                self.indent(2) + 'if(exclusive) ' + unlockExclusive + '; else ' + unlockShared + ';\n' +
+                self.indent() + '}\n\n'
+                'private:\n' +
+                self.indent() + 'PyBindingsGuard(const PyBindingsGuard&);\n' +
+                self.indent() + 'PyBindingsGuard& operator=(const PyBindingsGuard&);\n\n' +
+                self.indent() + 'PyBindingsLock& lock;\n' +
+                self.indent() + 'bool exclusive;\n'
+                '};\n\n')
+
+    def getShareImplementation(self):
+        """
+        Return the C++ code counting the owners of the shared objects.
+
+        The objects are created by many functions, among which the methods of
+        the classes, so their number of owners cannot be stored with them. It
+        is stored by address in one map per lock, protected by that lock: the
+        callers hold the exclusive lock of the object.
+        """
+        return ('/* Number of additional owners of the shared objects, by address. */\n'
+                '#include <map>\n\n'
+                'static std::map<const void*, long> pybindingsShares[sizeof(pybindingsLocks) / '
+                'sizeof(pybindingsLocks[0])];\n\n'
+                'static void pybindingsRetain(const void* obj)\n'
+                '{\n' +
+                self.indent() + '++pybindingsShares[pybindingsStripe(obj)][obj];\n'
+                '}\n\n'
+                '/* Release an owner of the object and return true if it was the last one. */\n'
+                'static bool pybindingsRelease(const void* obj)\n'
+                '{\n' +
+                self.indent() + 'std::map<const void*, long>& shares = '
+                'pybindingsShares[pybindingsStripe(obj)];\n' +
+                self.indent() + 'std::map<const void*, long>::iterator share = shares.find(obj);\n' +
+                self.indent() + 'if(share == shares.end()) return true;\n' +
+                self.indent() + 'if(--share->second == 0) shares.erase(share);\n' +
+                self.indent() + 'return false;\n'
+                '}\n\n')
+
+    def getAccountingImplementation(self):
+        """
+        Return the C++ code of the helpers updating the accounting counters.
+
+        The counters are updated with atomic builtins so that they stay
+        consistent when native objects are created and destroyed from
+        several threads. The allocated bytes only take into account
+        sizeof(<class>), not the memory owned by the object itself.
+        """
+        return ('/* Live native object accounting. */\n'
+                '#if defined(_MSC_VER)\n' +
+                WINDOWS_INCLUDE +
+                '#define PYBINDING_ATOMIC_ADD(target, value) '
+                'InterlockedExchangeAdd(&(target), (value))\n'
+                '#define PYBINDING_ATOMIC_CAS(target, expected, value) '
+                '(InterlockedCompareExchange(&(target), (value), (expected)) == (expected))\n'
+                '#else\n'
+                '#define PYBINDING_ATOMIC_ADD(target, value) '
+                '__sync_fetch_and_add(&(target), (value))\n'
+                '#define PYBINDING_ATOMIC_CAS(target, expected, value) '
+                '__sync_bool_compare_and_swap(&(target), (expected), (value))\n'
+                '#endif\n\n'
+                'static PyBindingsStats pybindingsTotalStats = {"*", 0, 0, 0, 0};\n\n'
+                'static void raiseHighWater(long& highWater, long value)\n'
+                '{\n' +
+                self.indent() + 'long current = highWater;\n' +
+                self.indent() + 'while(value > current && !PYBINDING_ATOMIC_CAS(highWater, current, value))\n' +
+                self.indent(2) + 'current = highWater;\n'
+                '}\n\n'
+                'static void resetHighWater(long& highWater, long& value)\n'
+                '{\n' +
+                self.indent() + 'long current = highWater;\n' +
+                self.indent() + 'while(!PYBINDING_ATOMIC_CAS(highWater, current, '
+                'PYBINDING_ATOMIC_ADD(value, 0)))\n' +
+                self.indent(2) + 'current = highWater;\n' +
+                self.indent() + '/* The value may have been raised since it was read. */\n' +
+                self.indent() + 'raiseHighWater(highWater, PYBINDING_ATOMIC_ADD(value, 0));\n'
+                '}\n\n'
+                'static void updateStats(PyBindingsStats& stats, long instances, long bytes)\n'
+                '{\n' +
+                self.indent() + 'long live = PYBINDING_ATOMIC_ADD(stats.liveInstances, instances) + instances;\n' +
+                self.indent() + 'long allocated = PYBINDING_ATOMIC_ADD(stats.allocatedBytes, bytes) + bytes;\n' +
+                self.indent() + 'raiseHighWater(stats.highWaterInstances, live);\n' +
+                self.indent() + 'raiseHighWater(stats.highWaterBytes, allocated);\n'
+                '}\n\n'
+                'static void pybindingsTrackNew(PyBindingsStats& stats, long size)\n'
+                '{\n' +
+                self.indent() + 'updateStats(stats, 1, size);\n' +
+                self.indent() + 'updateStats(pybindingsTotalStats, 1, size);\n'
+                '}\n\n'
+                'static void pybindingsTrackDelete(PyBindingsStats& stats, long size)\n'
+                '{\n' +
+                self.indent() + 'updateStats(stats, -1, -size);\n' +
+                self.indent() + 'updateStats(pybindingsTotalStats, -1, -size);\n'
+                '}\n\n' +
+                # The counters are all defined here, since the methods returning
+                # an owned object count it in the counters of its class.
+                ''.join('static PyBindingsStats ' + className + '_stats = {"' + className +
+                        '", 0, 0, 0, 0};\n' for className in self._accountedClasses) + '\n')
+
+    def finalizeImplementation(self):
+        """
+        Finalize the C API implementation. This writes the deletion functions
+        of the vectors returned by value and the command interpreter, if
+        enabled, which dispatches to all the classes. When the accounting is enabled,
+        this also writes the table of the per class counters and the functions
+        giving access to it, since all the classes are known at this point.
+        """
+        with self._openOutput(self._implementationFilename, 'a') as fp:
+            for elementType in sorted(self._vectorElementTypes):
+                fp.write('void pybindings_vector_' + elementType + '_delete(void* vector)\n'
+                        '{\n' +
+                        self.indent() + 'delete static_cast<std::vector<' + elementType +
+                        '>*>(vector);\n'
+                        '}\n\n')
+            if self._commandBuffer:
+                fp.write(self.getCommandInterpreter())
+            if self._dispatchTable:
+                fp.write(self.getTableImplementation())
+        if not self._accounting:
+            return
+
+        statsNames = ['&' + className + '_stats' for className in self._accountedClasses]
+        # An empty initializer list is not valid, so always end the
+        # table with a NULL sentinel.
+        statsNames.append('NULL')
+        with self._openOutput(self._implementationFilename, 'a') as fp:
+            fp.write('static PyBindingsStats* pybindingsStatsTable[] = {' +
+                    self.appendValuesToString(statsNames, '') + '};\n\n' +
+                    'int pybindings_stats_count()\n'
+                    '{\n' +
+                    self.indent() + 'return ' + str(len(self._accountedClasses)) + ';\n'
+                    '}\n\n'
+                    'int pybindings_stats_snapshot(PyBindingsStats* stats, int capacity)\n'
+                    '{\n' +
+                    self.indent() + 'int i = 0;\n' +
+                    self.indent() + 'for(; i < capacity && pybindingsStatsTable[i] != NULL; ++i)\n' +
+                    self.indent(2) + 'stats[i] = *pybindingsStatsTable[i];\n' +
+                    self.indent() + 'return i;\n'
+                    '}\n\n'
+                    'void pybindings_stats_total(PyBindingsStats* stats)\n'
+                    '{\n' +
+                    self.indent() + '*stats = pybindingsTotalStats;\n'
+                    '}\n\n'
+                    'void pybindings_stats_reset_high_water()\n'
+                    '{\n' +
+                    self.indent() + 'for(int i = 0; pybindingsStatsTable[i] != NULL; ++i)\n' +
+                    self.indent() + '{\n' +
+                    self.indent(2) + 'resetHighWater(pybindingsStatsTable[i]->highWaterInstances, '
+                    'pybindingsStatsTable[i]->liveInstances);\n' +
+                    self.indent(2) + 'resetHighWater(pybindingsStatsTable[i]->highWaterBytes, '
+                    'pybindingsStatsTable[i]->allocatedBytes);\n' +
+                    self.indent() + '}\n' +
+                    self.indent() + 'resetHighWater(pybindingsTotalStats.highWaterInstances, '
+                    'pybindingsTotalStats.liveInstances);\n' +
+                    self.indent() + 'resetHighWater(pybindingsTotalStats.highWaterBytes, '
+                    'pybindingsTotalStats.allocatedBytes);\n'
+                    '}\n\n')
+
     def initializeWrapper(self):
         """Add its header to the Python wrapper file."""
-        with open(self._wrapperFilename, 'w') as fp:
+        if (self._wrapperPackage and self._outputs is None and
+                not os.path.isdir(self._wrapperPackage)):
+            os.makedirs(self._wrapperPackage)
+        with self._openOutput(self._wrapperFilename, 'w') as fp:
             header = ('#!/usr/bin/python\n'
                     '"""\nFile automatically generated by the pybindings project.\n'
                     'This file implements a Python wrapper using ctypes for\n'
-                    'the C++ objects exported in the ' + self._libraryName + ' library.\n"""\n'
-                    'import unittest\n'
+                    'the C++ objects exported in the ' + self._libraryName + ' library.\n"""\n' +
+                    ''.join('import ' + module + '\n' for module in self.getWrapperImports()) +
                     'from ctypes import cdll\n'
                     'LIB = cdll.LoadLibrary(\'')
             if platform.system() == 'Windows':
@@ -162,36 +942,226 @@ class PyAPIWriter(object):
             else:
                 header += './'
             header += self._libraryName + '\')\n\n'
+            if self._dispatchTable:
+                header = header.replace('LIB = cdll', '_LIBRARY = cdll') + self.getTableWrapper()
+            if self._accounting:
+                header += self.getAccountingWrapper()
+            if self._usesContainers:
+                header += self.getContainerWrapper()
+            if self._structureClasses:
+                header += self.getStructureWrapper()
+            if self._memoize:
+                header += self.getMemoizationWrapper()
+            if self._identityMap:
+                header += self.getIdentityMapWrapper()
+            if self._sharedHandles:
+                header += self.getShareWrapper()
             fp.write(header)
 
+    def getWrapperImports(self, classModule=False):
+        """
+        Return the sorted names of the modules imported by the Python wrapper,
+        or by a module of the wrapper package if 'classModule' is True,
+        according to the enabled features.
+        """
+        if self._wrapperPackage and not classModule:
+            # The unit tests live in the class modules.
+            modules = set(['importlib'])
+        else:
+            modules = set(['unittest'])
+        if classModule or not self._wrapperPackage:
+            # The prototypes of the functions of the classes use ctypes.
+            modules.add('ctypes')
+        if not classModule:
+            if (self._accounting or self._usesContainers or self._commandBuffer or
+                    self._pickling or self._dispatchTable or self._structureClasses or
+                    self._identityMap or self._sharedHandles):
+                modules.add('ctypes')
+            if self._commandBuffer:
+                modules.update(['functools', 'struct'])
+            if self._identityMap:
+                modules.update(['sys', 'threading', 'weakref'])
+            if self._sharedHandles:
+                modules.update(['threading', 'weakref'])
+        return sorted(modules)
+
+    def getTableWrapper(self):
+        """
+        Return the Python code building the functions of the C API from the
+        dispatch table of the library.
+        """
+        python = ('\nclass _PyBindingsTable(ctypes.Structure):\n' +
+                self.indent() + '_fields_ = [(\'count\', ctypes.c_int),\n' +
+                self.indent(3) + '(\'functions\', ctypes.POINTER(ctypes.c_void_p))]\n\n\n'
+                'class _DispatchTable(object):\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Functions of the C API, built with their ctypes prototype from\n' +
+                self.indent() + 'the table returned by the pybindings_table function of the library.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'def __init__(self, library, prototypes):\n' +
+                self.indent(2) + 'getTable = library.pybindings_table\n' +
+                self.indent(2) + 'getTable.restype = ctypes.POINTER(_PyBindingsTable)\n' +
+                self.indent(2) + 'table = getTable().contents\n' +
+                self.indent(2) + 'if table.count != len(prototypes):\n' +
+                self.indent(3) + 'raise ImportError(\'The library does not match its wrapper.\')\n' +
+                self.indent(2) + 'addresses = table.functions[:table.count]\n' +
+                self.indent(2) + 'for address, (name, restype, argtypes) in zip(addresses, prototypes):\n' +
+                self.indent(3) + 'if argtypes is None:\n' +
+                self.indent(4) + 'function = ctypes.CFUNCTYPE(restype)(address)\n' +
+                self.indent(4) + 'function.argtypes = None\n' +
+                self.indent(3) + 'else:\n' +
+                self.indent(4) + 'function = ctypes.CFUNCTYPE(restype, *argtypes)(address)\n' +
+                self.indent(3) + 'setattr(self, name, function)\n\n\n'
+                '# Prototypes of the functions of the dispatch table, in order.\n'
+                'LIB = _DispatchTable(_LIBRARY, (\n')
+        for name, restype, argtypes in self._tableFunctions:
+            python += (self.indent() + '(\'' + name + '\', ' + restype + ', ' + str(argtypes) +
+                    '),\n')
+        return python + '))\n\n'
+
+    def initializeClassModule(self, className, structureTypes=()):
+        """
+        Start the module of the wrapper package containing the Python
+        wrapper of the class 'className', which uses the structures
+        'structureTypes'.
+        """
+        self._wrappedClasses.append(className)
+        self._wrapperFilename = os.path.join(self._wrapperPackage, '_' + className + '.py')
+        with self._openOutput(self._wrapperFilename, 'w') as fp:
+            fp.write('#!/usr/bin/python\n'
+                    '"""\nFile automatically generated by the pybindings project.\n'
+                    'This file implements the Python wrapper of the C++ class ' + className + '.\n'
+                    'It is imported on demand by the ' + self._wrapperPackage + ' package.\n"""\n')
+            for module in self.getWrapperImports(classModule=True):
+                fp.write('import ' + module + '\n')
+            if self._usesContainers and self._structureClasses:
+                fp.write('from . import (LIB, _NativeBuffer, _NativeVector, _StructureBuffer,\n' +
+                        self.indent(2) + '_nativeArray)\n')
+            elif self._usesContainers:
+                fp.write('from . import LIB, _NativeBuffer, _NativeVector, _nativeArray\n')
+            else:
+                fp.write('from . import LIB\n')
+            if className in self._structureClasses:
+                fp.write('from . import _setLayout\n')
+            structureTypes = sorted(set(structureTypes) - set([className]))
+            if structureTypes:
+                fp.write('from . import ' + ', '.join(structureTypes) + '\n')
+            if self._accounting:
+                fp.write('from . import nativeObjectStats\n')
+            if self._memoize:
+                fp.write('from . import _memoize' +
+                        (', _dropCache' if self._sharedHandles else '') + '\n')
+            if self._identityMap:
+                fp.write('from . import _WRAPPERS, _wrapPointer\n')
+            if self._sharedHandles:
+                fp.write('from . import _shareWrapper' +
+                        (', _handOver' if self._identityMap else '') + '\n')
+            fp.write('\n\n')
+
+    def finalizeWrapperPackage(self):
+        """
+        Finalize the package '__init__.py' by adding the module level
+        __getattr__ importing the class modules on first access.
+        """
+        self._wrapperFilename = os.path.join(self._wrapperPackage, '__init__.py')
+        with self._openOutput(self._wrapperFilename, 'a') as fp:
+            if self._commandBuffer:
+                fp.write(self.getCommandBufferWrapper())
+            fp.write('# Modules of the wrapped classes, imported on first access.\n'
+                    '_CLASS_MODULES = {\n')
+            for className in self._wrappedClasses:
+                fp.write(self.indent() + '\'' + className + '\': \'._' + className + '\',\n')
+            fp.write('}\n\n\n'
+                    'def __getattr__(name):\n' +
+                    self.indent() + 'try:\n' +
+                    self.indent(2) + 'moduleName = _CLASS_MODULES[name]\n' +
+                    self.indent() + 'except KeyError:\n' +
+                    self.indent(2) + 'raise AttributeError(\'module %r has no attribute %r\' % '
+                    '(__name__, name))\n' +
+                    self.indent() + 'class_ = getattr(importlib.import_module(moduleName, __name__), name)\n' +
+                    self.indent() + '# Cache the class so that __getattr__ is not called anymore.\n' +
+                    self.indent() + 'globals()[name] = class_\n' +
+                    self.indent() + 'return class_\n\n\n'
+                    'def __dir__():\n' +
+                    self.indent() + 'return sorted(set(globals()) | set(_CLASS_MODULES))\n')
+
+    def getAccountingWrapper(self):
+        """
+        Return the Python code giving access to the accounting counters
+        of the C API.
+        """
+        return ('class PyBindingsStats(ctypes.Structure):\n' +
+                self.indent() + '_fields_ = [(\'className\', ctypes.c_char_p),\n' +
+                self.indent(3) + '(\'liveInstances\', ctypes.c_long),\n' +
+                self.indent(3) + '(\'allocatedBytes\', ctypes.c_long),\n' +
+                self.indent(3) + '(\'highWaterInstances\', ctypes.c_long),\n' +
+                self.indent(3) + '(\'highWaterBytes\', ctypes.c_long)]\n\n' +
+                self.indent() + 'def toDict(self):\n' +
+                self.indent(2) + 'return {\'live\': self.liveInstances,\n' +
+                self.indent(3) + '\'bytes\': self.allocatedBytes,\n' +
+                self.indent(3) + '\'highWaterLive\': self.highWaterInstances,\n' +
+                self.indent(3) + '\'highWaterBytes\': self.highWaterBytes}\n\n\n'
+                'def nativeObjectStats():\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Return a snapshot of the live native objects, as a dictionary\n' +
+                self.indent() + 'mapping the class names to their counters.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'count = LIB.pybindings_stats_count()\n' +
+                self.indent() + 'stats = (PyBindingsStats * count)()\n' +
+                self.indent() + 'count = LIB.pybindings_stats_snapshot(stats, count)\n' +
+                self.indent() + 'snapshot = {}\n' +
+                self.indent() + 'for record in stats[:count]:\n' +
+                self.indent(2) + 'snapshot[record.className.decode()] = record.toDict()\n' +
+                self.indent() + 'return snapshot\n\n\n'
+                'def nativeHighWaterMark():\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Return the highest number of live native objects and allocated\n' +
+                self.indent() + 'bytes reached by all the classes together.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'total = PyBindingsStats()\n' +
+                self.indent() + 'LIB.pybindings_stats_total(ctypes.byref(total))\n' +
+                self.indent() + 'return {\'live\': total.highWaterInstances,\n' +
+                self.indent(2) + '\'bytes\': total.highWaterBytes}\n\n\n'
+                'def resetNativeHighWaterMark():\n' +
+                self.indent() + '"""Reset all the high water marks to the current counters."""\n' +
+                self.indent() + 'LIB.pybindings_stats_reset_high_water()\n\n\n')
+
     def finalizeWrapper(self):
         """
         Finalize the Python wrapper implementation by adding an 'if main'
         statement running the unit tests.
         """
-        self.addBlankLine(self._wrapperFilename)
-        with open(self._wrapperFilename, 'a') as fp:
+        # With the per class layout, the command buffer is written to the
+        # package '__init__.py' by finalizeWrapperPackage.
+        if self._commandBuffer and not self._wrapperPackage:
+            with self._openOutput(self._wrapperFilename, 'a') as fp:
+                fp.write('\n' + self.getCommandBufferWrapper())
+        else:
+            self.addBlankLine(self._wrapperFilename)
+        with self._openOutput(self._wrapperFilename, 'a') as fp:
             fp.write('if __name__ == \'__main__\':\n' +
                     self.indent() + 'unittest.main()\n\n')
 
-    def concatenateTesterClass(self):
-        """
-        Concatenate all the stuff that is in the temporary file containing
-        the unit tests to the actual wrapper file.
-        Then delete that temporary file.
-        """
-        self.addBlankLine(self._wrapperFilename)
-        with open(self._wrapperFilename, 'a') as fp:
-            for line in open(self._testerFilename):
-                fp.write(line)
-        os.remove(self._testerFilename)
-
     def addBlankLine(self, filename):
         """Add a blank line to the file corresponding to filename."""
-        with open(filename, 'a') as fp:
+        with self._openOutput(filename, 'a') as fp:
             fp.write('\n')
 
-    def writeConstructor(self, constructor):
+    def writeClassAccounting(self, fragments, class_):
+        """
+        Write the unit test of the accounting counters of the CPPClass 'class_',
+        which are defined with the others by getAccountingImplementation.
+        """
+        className = class_.getName()
+        python = (self.indent() + 'def testAccounting(self):\n' +
+                self.indent(2) + 'before = nativeObjectStats()[\'' + className + '\'][\'live\']\n' +
+                self.indent(2) + 'obj = ' + className + '()\n' +
+                self.indent(2) + 'self.assertTrue(obj)\n' +
+                self.indent(2) + 'self.assertEqual(nativeObjectStats()[\'' + className +
+                '\'][\'live\'], before + 1)\n\n')
+        fragments.tester += python
+
+    def writeConstructor(self, fragments, constructor):
         """
         Write the C API and the Python wrapper
         corresponding to the CPPConstructor 'constructor'.
@@ -202,20 +1172,23 @@ class PyAPIWriter(object):
         # Since it is not possible to overload functions in ansi C, if there are
         # several constructors in the current class, they must all have
         # different names. So the constructors names will be:
-        # <className>_new[_<number of the constructor in the file>]
-        # Where the order of the constructor in the file is given by:
-        # self._writtenConstructors
+        # <className>_new[_<number of the constructor in the class>]
+        # Where the order of the constructor in the class is given by:
+        # fragments.writtenConstructors
         constructorName = constructor.getName() + '_new'
-        if self._writtenConstructors != 0:
-            constructorName += '_' + str(self._writtenConstructors)
-        self._writtenConstructors += 1
+        if fragments.writtenConstructors != 0:
+            constructorName += '_' + str(fragments.writtenConstructors)
+        fragments.writtenConstructors += 1
+        if constructor.isCopyConstructor():
+            fragments.copyConstructorName = constructorName
 
         decl = constructorName + '('
         if constructor.hasParameters() > 0:
             decl = self.appendValuesToString(constructor.getParameters(), decl)
         decl += ')'
-        with open(self._headerFilename, 'a') as fp:
-            fp.write(self.indent() + 'PYBINDING_API ' + constructor.getName() + '* ' + decl + ';\n')
+        fragments.declaration += self.indent() + 'PYBINDING_API ' + constructor.getName() + '* ' + decl + ';\n'
+        fragments.prototypes += self.getPrototype(constructorName, constructor.getName() + '*',
+                [str(parameter) for parameter in constructor.getParameters()])
 
         # Handle implementation.
         # Iif necessary, make a list of the names of the parameters of the constructor.
@@ -224,12 +1197,24 @@ class PyAPIWriter(object):
             parameterNames = [parameter.getName() for parameter in constructor.getParameters()]
 
         impl = (constructor.getName() + '* ' + decl + '\n' +
-                    '{\n' + self.indent() + 'return new ' + constructor.getName() + '(')
+                    '{\n' + self.indent())
+        if self._threadSafe and constructor.isCopyConstructor():
+            impl += ('PyBindingsGuard guard(&' + parameterNames[0] + ', false);\n' +
+                    self.indent())
+        if self._accounting:
+            impl += constructor.getName() + '* newObject = '
+        else:
+            impl += 'return '
+        impl += 'new ' + constructor.getName() + '('
         if constructor.hasParameters():
             impl = self.appendValuesToString(parameterNames, impl)
-        impl += ');\n}\n\n'
-        with open(self._implementationFilename, 'a') as fp:
-            fp.write(impl)
+        impl += ');\n'
+        if self._accounting:
+            impl += (self.indent() + 'pybindingsTrackNew(' + constructor.getName() +
+                    '_stats, sizeof(' + constructor.getName() + '));\n' +
+                    self.indent() + 'return newObject;\n')
+        impl += '}\n\n'
+        fragments.implementation += impl
 
         # Handle wrapper.
         python = self.indent() + 'def __init__(self'
@@ -239,18 +1224,25 @@ class PyAPIWriter(object):
             python += ', '
             python = self.appendValuesToString(parameterNames, python)
         python += ('):\n' +
-                self.indent(2) + 'self._obj = LIB.' + constructorName + '()\n\n')
-        with open(self._wrapperFilename, 'a') as fp:
-            fp.write(python)
+                self.indent(2) + 'self._obj = LIB.' + constructorName + '(')
+        if constructor.hasParameters():
+            python = self.appendValuesToString(parameterNames, python)
+        python += ')\n'
+        if self._identityMap:
+            python += (self.indent(2) + '_WRAPPERS[(\'' + constructor.getName() +
+                    '\', self._obj)] = self\n')
+        if self._memoize:
+            # Results of the memoized methods, by method name.
+            python += self.indent(2) + 'self._cache = {}\n'
+        fragments.wrapper += python + '\n'
 
         # Handle unit test.
         python = (self.indent() + 'def testConstructor(self):\n' +
                 self.indent(2) + 'obj = ' + constructor.getName() + '()\n' +
                 self.indent(2) + 'self.assertTrue(obj)\n\n')
-        with open(self._testerFilename, 'a') as fp:
-            fp.write(python)
+        fragments.tester += python
 
-    def writeDestructor(self, destructor):
+    def writeDestructor(self, fragments, destructor):
         """
         Write the C API and the Python wrapper
         corresponding to the CPPDestructor 'destructor'.
@@ -259,22 +1251,35 @@ class PyAPIWriter(object):
         # Handle declaration.
         destructorName = destructor.getName() + '_delete'
         decl = 'void ' + destructorName + '(' + destructor.getName() + '* obj)'
-        with open(self._headerFilename, 'a') as fp:
-            fp.write(self.indent() + 'PYBINDING_API ' + decl + ';\n')
+        fragments.declaration += self.indent() + 'PYBINDING_API ' + decl + ';\n'
+        fragments.prototypes += self.getPrototype(destructorName, 'void',
+                [destructor.getName() + '* obj'])
 
         # Handle implementation.
         impl = decl + '\n{\n' + self.indent()
         impl = self.appendNullObjectTestToString(impl)
-        impl += '\n\n' + self.indent() + 'delete obj; obj = NULL;\n}\n\n'
-        with open(self._implementationFilename, 'a') as fp:
-            fp.write(impl)
+        if self._sharedHandles:
+            # The lock of the object also protects its number of owners.
+            impl += ('\n' + self.indent() + 'PyBindingsGuard guard(obj, true);\n' +
+                    self.indent() + 'if(!pybindingsRelease(obj)) return;')
+        else:
+            impl = self.appendLockToString(impl, 'obj', True)
+        impl += '\n\n' + self.indent()
+        if self._accounting:
+            impl += ('if(obj != NULL) pybindingsTrackDelete(' + destructor.getName() +
+                    '_stats, sizeof(' + destructor.getName() + '));\n' + self.indent())
+        impl += 'delete obj; obj = NULL;\n}\n\n'
+        fragments.implementation += impl
 
         # Handle wrapper.
         python = (self.indent() + 'def __del__(self):\n' +
-                self.indent(2) + 'if hasattr(self, \'_obj\'):\n' +
-                self.indent(3) + 'LIB.' + destructorName + '(self._obj)\n\n')
-        with open(self._wrapperFilename, 'a') as fp:
-            fp.write(python)
+                self.indent(2) + 'if hasattr(self, \'_obj\')' +
+                (' and self._owned' if self._identityMap else '') + ':\n')
+        if self._identityMap and self._sharedHandles:
+            python += (self.indent(3) + 'if self._shares:\n' +
+                    self.indent(4) + '_handOver(self)\n')
+        python += self.indent(3) + 'LIB.' + destructorName + '(self._obj)\n\n'
+        fragments.wrapper += python
 
         # Handle unit test.
         python = (self.indent() + 'def testDestructor(self):\n' +
@@ -282,46 +1287,380 @@ class PyAPIWriter(object):
                 self.indent(2) + 'self.assertTrue(obj)\n' +
                 self.indent(2) + 'obj = None\n' +
                 self.indent(2) + 'self.assertFalse(obj)\n\n')
-        with open(self._testerFilename, 'a') as fp:
-            fp.write(python)
+        fragments.tester += python
+
 
+    def writeShare(self, fragments, class_):
+        """
+        Write the C API and the Python wrapper sharing the objects of the
+        CPPClass 'class_' between several owners, see getShareImplementation.
+        """
+        print(self.indent() + 'Writing share...')
+        className = class_.getName()
+        # Handle declaration.
+        shareName = className + '_share'
+        decl = className + '* ' + shareName + '(' + className + '* obj)'
+        fragments.declaration += self.indent() + 'PYBINDING_API ' + decl + ';\n'
+
+        # Handle implementation.
+        impl = decl + '\n{\n' + self.indent()
+        impl = self.appendNullObjectTestToString(impl)
+        impl += ('\n' + self.indent() + 'PyBindingsGuard guard(obj, true);\n' +
+                self.indent() + 'pybindingsRetain(obj);\n' +
+                self.indent() + 'return obj;\n'
+                '}\n\n')
+        fragments.implementation += impl
+
+        # Handle wrapper.
+        python = (self.indent() + '# Wrappers sharing the native object of this one, see share().\n' +
+                self.indent() + '_shares = ()\n\n' +
+                self.indent() + 'def share(self):\n' +
+                self.indent(2) + '"""\n' +
+                self.indent(2) + 'Return a new wrapper sharing the native object with this one, which\n' +
+                self.indent(2) + 'is deleted when all the wrappers sharing it are collected.\n' +
+                self.indent(2) + '"""\n' +
+                self.indent(2) + 'obj = ' + className + '.__new__(' + className + ')\n')
+        if self._identityMap:
+            python += (self.indent(2) + 'if not self._owned:\n' +
+                    self.indent(3) + '# The object belongs to another one, which the share keeps alive.\n' +
+                    self.indent(3) + 'obj._obj = self._obj\n' +
+                    self.indent(3) + 'obj._owned = False\n' +
+                    self.indent(3) + 'obj._owner = self._owner\n' +
+                    self.indent(2) + 'else:\n' +
+                    self.indent(3) + 'obj._obj = LIB.' + shareName + '(self._obj)\n')
+        else:
+            python += self.indent(2) + 'obj._obj = LIB.' + shareName + '(self._obj)\n'
+        if self._memoize:
+            python += self.indent(2) + 'obj._cache = {}\n'
+        python += (self.indent(2) + '_shareWrapper(self, obj)\n' +
+                self.indent(2) + 'return obj\n\n')
+        fragments.wrapper += python
+        fragments.prototypes += self.getPrototype(shareName, className + '*',
+                [className + '* obj'])
+
+        # Handle unit test.
+        python = (self.indent() + 'def testShare(self):\n' +
+                self.indent(2) + 'obj = ' + className + '()\n' +
+                self.indent(2) + 'shared = obj.share()\n' +
+                self.indent(2) + 'self.assertEqual(obj._obj, shared._obj)\n\n')
+        fragments.tester += python
+
+    def writeStructure(self, fragments, class_):
+        """
+        Write the fields of the ctypes structure wrapping the plain old data
+        CPPClass 'class_', and the C API function returning its layout, from
+        which the Python wrapper sets and checks the fields when it is imported.
+        """
+        print(self.indent() + 'Writing structure...')
+        className = class_.getName()
+        members = [member for member in class_.getMembers() if not member.isStatic()]
+        # Handle declaration.
+        layoutName = className + '_layout'
+        decl = 'size_t ' + layoutName + '(size_t* offsets)'
+        fragments.declaration += self.indent() + 'PYBINDING_API ' + decl + ';\n'
+
+        # Handle implementation.
+        impl = decl + '\n{\n'
+        for index, member in enumerate(members):
+            impl += (self.indent() + 'offsets[' + str(index) + '] = offsetof(' + className + ', ' +
+                    member.getName() + ');\n')
+        impl += self.indent() + 'return sizeof(' + className + ');\n}\n\n'
+        fragments.implementation += impl
+
+        # Handle wrapper.
+        fields = ['(\'' + member.getName() + '\', ' + self.getFieldCType(member) + ')'
+                for member in members]
+        python = (self.indent() + '# Fields of the structure, in any order, see _setLayout.\n' +
+                self.indent() + '_members = [' + (',\n' + self.indent(3)).join(fields) + ']\n\n' +
+                self.indent() + '@property\n' +
+                self.indent() + 'def _obj(self):\n' +
+                self.indent(2) + '"""Address of the structure, which is the native object."""\n' +
+                self.indent(2) + 'return ctypes.addressof(self)\n\n')
+        fragments.wrapper += python
+        fragments.prototypes += ('LIB.' + layoutName + '.restype = ctypes.c_size_t\n' +
+                '_setLayout(' + className + ', LIB.' + layoutName + ')\n')
+
+        # Handle unit test.
+        python = (self.indent() + 'def testLayout(self):\n' +
+                self.indent(2) + 'offsets = (ctypes.c_size_t * len(' + className + '._members))()\n' +
+                self.indent(2) + 'self.assertEqual(LIB.' + layoutName + '(offsets), ctypes.sizeof(' +
+                className + '))\n\n')
+        fragments.tester += python
 
-    def writeMethod(self, className, method):
+    def hasSerializer(self, class_):
+        """
+        Return True if the CPPClass 'class_' declares the methods
+        'serialize() const' returning a std::string and
+        'deserialize(const std::string&)', and can be default constructed.
+        """
+        serializers = [method for method in class_.getMethods()
+                if method.getName() == 'serialize' and method.isConst() and
+                not method.hasParameters() and method.getReturnValue().isString()]
+        deserializers = [method for method in class_.getMethods()
+                if method.getName() == 'deserialize' and len(method.getParameters()) == 1 and
+                method.getParameters()[0].isString()]
+        defaultConstructible = (not class_.getConstructors() or
+                any(not constructor.hasParameters() for constructor in class_.getConstructors()))
+        return len(serializers) > 0 and len(deserializers) > 0 and defaultConstructible
+
+    def writeSerialization(self, fragments, class_):
+        """
+        Write the serialization of the CPPClass 'class_': the C API shims
+        serializing and deserializing one object or an array of objects, and
+        the __reduce__ method of the Python wrapper using them.
+
+        The C API serialization functions take a buffer and its capacity and
+        return the size of the serialization, so that they can be called again
+        with a large enough buffer. The arrays of objects are serialized in a
+        single buffer, each object preceded by its size as a size_t.
+
+        When the class has no serializer, the Python wrapper only supports the
+        copy module, through the copy constructor if there is one, and refuses
+        to be pickled: the address of a native object is meaningless in
+        another process.
+        """
+        className = class_.getName()
+        python = (self.indent() + '@classmethod\n' +
+                self.indent() + 'def _fromPointer(cls, pointer):\n' +
+                self.indent(2) + '"""Return a wrapper owning the native object at \'pointer\'."""\n' +
+                self.indent(2) + 'obj = cls.__new__(cls)\n' +
+                self.indent(2) + 'obj._obj = pointer\n')
+        if self._memoize:
+            python += self.indent(2) + 'obj._cache = {}\n'
+        if self._identityMap:
+            python += self.indent(2) + '_WRAPPERS[(\'' + className + '\', pointer)] = obj\n'
+        python += self.indent(2) + 'return obj\n\n'
+
+        if fragments.copyConstructorName is not None:
+            python += (self.indent() + 'def __copy__(self):\n' +
+                    self.indent(2) + 'return ' + className + '._fromPointer(LIB.' +
+                    fragments.copyConstructorName + '(self._obj))\n\n' +
+                    self.indent() + 'def __deepcopy__(self, memo):\n' +
+                    self.indent(2) + 'return self.__copy__()\n\n')
+
+        if not self.hasSerializer(class_):
+            python += (self.indent() + 'def __reduce__(self):\n' +
+                    self.indent(2) + 'raise TypeError(\'' + className + ' objects cannot be pickled: '
+                    'the C++ class does not declare serialize() and deserialize().\')\n\n')
+            fragments.wrapper += python
+            return
+
+        # Handle declaration.
+        serializeDecl = ('size_t ' + className + '_to_bytes(' + className +
+                '* obj, char* buffer, size_t capacity)')
+        deserializeDecl = (className + '* ' + className +
+                '_from_bytes(const char* data, size_t size)')
+        serializeArrayDecl = ('size_t ' + className + '_to_bytes_array(' + className +
+                '** objects, size_t count, char* buffer, size_t capacity)')
+        deserializeArrayDecl = ('size_t ' + className + '_from_bytes_array(const char* buffer, '
+                'size_t size, ' + className + '** objects, size_t capacity)')
+        for decl in (serializeDecl, deserializeDecl, serializeArrayDecl, deserializeArrayDecl):
+            fragments.declaration += self.indent() + 'PYBINDING_API ' + decl + ';\n'
+
+        # Handle implementation.
+        impl = (serializeDecl + '\n'
+                '{\n' + self.indent())
+        impl = self.appendNullObjectTestToString(impl)
+        impl = self.appendLockToString(impl, 'obj', False)
+        impl += ('\n\n' +
+                self.indent() + 'std::string data = obj->serialize();\n' +
+                self.indent() + 'if(data.size() <= capacity)\n' +
+                self.indent(2) + 'data.copy(buffer, data.size());\n' +
+                self.indent() + 'return data.size();\n'
+                '}\n\n' +
+                deserializeDecl + '\n'
+                '{\n' +
+                self.indent() + className + '* obj = new ' + className + '();\n')
+        if self._accounting:
+            impl += (self.indent() + 'pybindingsTrackNew(' + className + '_stats, sizeof(' +
+                    className + '));\n')
+        impl += (self.indent() + 'obj->deserialize(std::string(data, size));\n' +
+                self.indent() + 'return obj;\n'
+                '}\n\n' +
+                serializeArrayDecl + '\n'
+                '{\n' +
+                self.indent() + 'size_t size = 0;\n' +
+                self.indent() + 'for(size_t i = 0; i < count; ++i)\n' +
+                self.indent() + '{\n' +
+                self.indent(2) + 'if(objects[i] == NULL) nullObjectError(__FUNCTION__);\n' +
+                self.indent(2) + 'std::string data;\n' +
+                self.indent(2) + '{\n' +
+                self.indent(3) + self.appendLockToString('', 'objects[i]', False).strip() + '\n' +
+                self.indent(3) + 'data = objects[i]->serialize();\n' +
+                self.indent(2) + '}\n' +
+                self.indent(2) + 'size_t dataSize = data.size();\n' +
+                self.indent(2) + 'if(size + sizeof(size_t) + dataSize <= capacity)\n' +
+                self.indent(2) + '{\n' +
+                self.indent(3) + 'memcpy(buffer + size, &dataSize, sizeof(size_t));\n' +
+                self.indent(3) + 'data.copy(buffer + size + sizeof(size_t), dataSize);\n' +
+                self.indent(2) + '}\n' +
+                self.indent(2) + 'size += sizeof(size_t) + dataSize;\n' +
+                self.indent() + '}\n' +
+                self.indent() + 'return size;\n'
+                '}\n\n' +
+                deserializeArrayDecl + '\n'
+                '{\n' +
+                self.indent() + '/* Without objects, only count the serialized objects. */\n' +
+                self.indent() + 'size_t count = 0;\n' +
+                self.indent() + 'size_t offset = 0;\n' +
+                self.indent() + 'while(offset + sizeof(size_t) <= size && '
+                '(objects == NULL || count < capacity))\n' +
+                self.indent() + '{\n' +
+                self.indent(2) + 'size_t dataSize;\n' +
+                self.indent(2) + 'memcpy(&dataSize, buffer + offset, sizeof(size_t));\n' +
+                self.indent(2) + 'offset += sizeof(size_t);\n' +
+                self.indent(2) + 'if(dataSize > size - offset)\n' +
+                self.indent(3) + 'break;\n' +
+                self.indent(2) + 'if(objects != NULL)\n' +
+                self.indent(3) + 'objects[count] = ' + className + '_from_bytes(buffer + offset, dataSize);\n' +
+                self.indent(2) + '++count;\n' +
+                self.indent(2) + 'offset += dataSize;\n' +
+                self.indent() + '}\n' +
+                self.indent() + 'return count;\n'
+                '}\n\n')
+        fragments.implementation += impl
+
+        # Handle wrapper.
+        python += (self.indent() + 'def toBytes(self):\n' +
+                self.indent(2) + '"""Return the serialization of the native object."""\n' +
+                self.indent(2) + 'buffer = ctypes.create_string_buffer(256)\n' +
+                self.indent(2) + 'size = LIB.' + className + '_to_bytes(self._obj, buffer, '
+                'ctypes.c_size_t(256))\n' +
+                self.indent(2) + 'if size > 256:\n' +
+                self.indent(3) + 'buffer = ctypes.create_string_buffer(size)\n' +
+                self.indent(3) + 'LIB.' + className + '_to_bytes(self._obj, buffer, '
+                'ctypes.c_size_t(size))\n' +
+                self.indent(2) + 'return buffer.raw[:size]\n\n' +
+                self.indent() + '@classmethod\n' +
+                self.indent() + 'def fromBytes(cls, data):\n' +
+                self.indent(2) + '"""Return a new object deserialized from the bytes \'data\'."""\n' +
+                self.indent(2) + 'return cls._fromPointer(LIB.' + className +
+                '_from_bytes(data, ctypes.c_size_t(len(data))))\n\n' +
+                self.indent() + 'def __reduce__(self):\n' +
+                self.indent(2) + 'return (' + className + '.fromBytes, (self.toBytes(),))\n\n' +
+                self.indent() + '@classmethod\n' +
+                self.indent() + 'def serializeMany(cls, objects, buffer=None):\n' +
+                self.indent(2) + '"""\n' +
+                self.indent(2) + 'Serialize the sequence \'objects\' with a single native call and\n' +
+                self.indent(2) + 'return the bytes. If a writable \'buffer\' is given, like the buf of a\n' +
+                self.indent(2) + 'multiprocessing.shared_memory.SharedMemory, the serialization is\n' +
+                self.indent(2) + 'written to it instead and its size is returned.\n' +
+                self.indent(2) + '"""\n' +
+                self.indent(2) + 'pointers = (ctypes.c_void_p * len(objects))(*[obj._obj for obj in objects])\n' +
+                self.indent(2) + 'count = ctypes.c_size_t(len(objects))\n' +
+                self.indent(2) + 'if buffer is not None:\n' +
+                self.indent(3) + 'target = (ctypes.c_char * len(buffer)).from_buffer(buffer)\n' +
+                self.indent(3) + 'size = LIB.' + className + '_to_bytes_array(pointers, count, target, '
+                'ctypes.c_size_t(len(buffer)))\n' +
+                self.indent(3) + 'if size > len(buffer):\n' +
+                self.indent(4) + 'raise ValueError(\'The buffer is too small, %d bytes are needed.\' % size)\n' +
+                self.indent(3) + 'return size\n' +
+                self.indent(2) + 'capacity = 64 * len(objects)\n' +
+                self.indent(2) + 'target = ctypes.create_string_buffer(capacity)\n' +
+                self.indent(2) + 'size = LIB.' + className + '_to_bytes_array(pointers, count, target, '
+                'ctypes.c_size_t(capacity))\n' +
+                self.indent(2) + 'if size > capacity:\n' +
+                self.indent(3) + 'target = ctypes.create_string_buffer(size)\n' +
+                self.indent(3) + 'LIB.' + className + '_to_bytes_array(pointers, count, target, '
+                'ctypes.c_size_t(size))\n' +
+                self.indent(2) + 'return target.raw[:size]\n\n' +
+                self.indent() + '@classmethod\n' +
+                self.indent() + 'def deserializeMany(cls, data):\n' +
+                self.indent(2) + '"""\n' +
+                self.indent(2) + 'Return the list of the objects serialized by serializeMany in \'data\',\n' +
+                self.indent(2) + 'which may be bytes or a writable buffer.\n' +
+                self.indent(2) + '"""\n' +
+                self.indent(2) + 'if not isinstance(data, bytes):\n' +
+                self.indent(3) + 'data = (ctypes.c_char * len(data)).from_buffer(data)\n' +
+                self.indent(2) + 'size = ctypes.c_size_t(len(data))\n' +
+                self.indent(2) + 'count = LIB.' + className + '_from_bytes_array(data, size, None, '
+                'ctypes.c_size_t(0))\n' +
+                self.indent(2) + 'pointers = (ctypes.c_void_p * count)()\n' +
+                self.indent(2) + 'LIB.' + className + '_from_bytes_array(data, size, pointers, '
+                'ctypes.c_size_t(count))\n' +
+                self.indent(2) + 'return [cls._fromPointer(pointer) for pointer in pointers]\n\n')
+        fragments.wrapper += python
+        for decl in (serializeDecl, deserializeDecl, serializeArrayDecl, deserializeArrayDecl):
+            cReturn, functionName, cParameters = re.match(r'(.+?)(\w+)\((.*)\)$', decl).groups()
+            fragments.prototypes += self.getPrototype(functionName, cReturn,
+                    cParameters.split(', '))
+
+    def writeMethod(self, fragments, className, method):
         """
         Write the C API and the Python wrapper
         corresponding to the CPPMethod 'method'.
+
+        The contiguous containers (see isMappedContainer) are passed to the
+        C API as a data pointer and a size. On the Python side they are
+        exchanged as NumPy arrays, or memoryviews when NumPy is not available.
+        The structures (see isStructureValue) are passed by value.
         """
         print(self.indent() + 'Writing method...')
+        structure = className in self._structureClasses
+        returnValue = method.getReturnValue()
+        returnsStructure = self.isStructureValue(returnValue)
+        returnsContainer = self.isMappedContainer(returnValue)
+        containerParameters = [parameter for parameter in method.getParameters()
+                if self.isMappedContainer(parameter)]
+        usesContainers = returnsContainer or len(containerParameters) > 0
+
         # Handle declaration.
         methodName = className + '_' + method.getName()
-        decl = (str(method.getReturnValue()) + ' ' + methodName + '(' +
-                className + '* obj')
-        if method.hasParameters():
-            decl += ', '
-            decl = self.appendValuesToString(method.getParameters(), decl)
-        decl += ')'
-        with open(self._headerFilename, 'a') as fp:
-            fp.write(self.indent() + 'PYBINDING_API ' + decl + ';\n')
+        cReturn = str(returnValue)
+        if returnsStructure:
+            cReturn = returnValue.getType()
+        cParameters = [className + '* obj']
+        for parameter in method.getParameters():
+            cParameters.extend(self.getCParameters(parameter))
+        if returnsContainer:
+            elementType = returnValue.getContainerElementType()
+            if returnValue.isReference():
+                # The vector belongs to the object, return a pointer on its data.
+                cReturn = 'const ' + elementType + '*'
+            else:
+                # The vector is copied on the heap and returned as an opaque
+                # handle that must be deleted with pybindings_vector_<type>_delete.
+                cReturn = 'void*'
+                cParameters.append(elementType + '** resultData')
+                fragments.vectorElementTypes.add(elementType)
+            cParameters.append('size_t* resultSize')
+        decl = cReturn + ' ' + methodName + '(' + self.appendValuesToString(cParameters, '') + ')'
+        fragments.declaration += self.indent() + 'PYBINDING_API ' + decl + ';\n'
+        fragments.prototypes += self.getPrototype(methodName, cReturn, cParameters)
+        fragments.structureTypes.update(parameter.getType() for parameter in method.getParameters()
+                if self.isStructureValue(parameter) or self.isStructureReference(parameter))
+        if returnsStructure:
+            fragments.structureTypes.add(returnValue.getType())
 
         # Handle implementation.
         impl = decl + '\n{\n' + self.indent()
         impl = self.appendNullObjectTestToString(impl)
+        impl = self.appendLockToString(impl, 'obj', not method.isConst())
         impl += '\n\n' + self.indent()
-        # If there is non-void return value, add the 'return' statement
-        # to the implementation string.
-        if method.getReturnValue().getType() != 'void':
-            impl += 'return '
-        impl += 'obj->' + method.getName() + '('
+        call = 'obj->' + method.getName() + '('
         parameterNames = []
         if method.hasParameters():
             # Make a list of the parameters names and
-            # add them to 'impl' separated by commas.
+            # add them to 'call' separated by commas.
             for parameter in method.getParameters():
                 parameterNames.append(parameter.getName())
-            impl = self.appendValuesToString(parameterNames, impl)
-        impl += ');\n}\n\n'
-        with open(self._implementationFilename, 'a') as fp:
-            fp.write(impl)
+            call = self.appendValuesToString(parameterNames, call)
+        call += ')'
+        if self.countsResult(className, method):
+            # The returned object is deleted by its wrapper, which counts it.
+            impl += (cReturn + ' result = ' + call + ';\n' +
+                    self.indent() + 'if(result != NULL) pybindingsTrackNew(' +
+                    returnValue.getType() + '_stats, sizeof(' + returnValue.getType() + '));\n' +
+                    self.indent() + 'return result;\n}\n\n')
+        elif not usesContainers:
+            # If there is non-void return value, add the 'return' statement
+            # to the implementation string.
+            if returnValue.getType() != 'void':
+                impl += 'return '
+            impl += call + ';\n}\n\n'
+        else:
+            impl += self.getContainerMethodBody(method, call)
+        fragments.implementation += impl
 
         # Handle wrapper.
         python = self.indent() + 'def ' + method.getName() + '(self'
@@ -332,18 +1671,110 @@ class PyAPIWriter(object):
             python += ', '
             python = self.appendValuesToString(parameterNames, python)
         python += '):\n' + self.indent(2)
-        # If there is non-void return value, add the 'return' statement
-        # to the wrapper string.
-        if method.getReturnValue().getType() != 'void':
-            python += 'return '
-        python += 'LIB.' + methodName + '(self._obj'
-        # If necessary add the parameters to the implementation.
-        if len(parameterNames) != 0:
-            python += ', '
-            python = self.appendValuesToString(parameterNames, python)
-        python += ')\n\n'
-        with open(self._wrapperFilename, 'a') as fp:
-            fp.write(python)
+        callArguments = ['self._obj']
+        if structure:
+            # This does not convert the address to an int.
+            callArguments = ['ctypes.byref(self)']
+        elif None in [self.getFunctionCType(parameter, True, True) for parameter in cParameters]:
+            # Without the parameter types, ctypes would truncate the address.
+            callArguments = ['ctypes.c_void_p(self._obj)']
+        for parameter in method.getParameters():
+            if self.isMappedContainer(parameter):
+                # Get the pointer and size of the memory of the sequence.
+                elementType = parameter.getContainerElementType()
+                bufferClass = '_NativeBuffer('
+                if elementType in self._structureClasses:
+                    bufferClass = '_StructureBuffer('
+                    fragments.structureTypes.add(elementType)
+                # The values written to a non-const reference vector must be
+                # copied back to the given array, not to a temporary copy.
+                writable = ''
+                if parameter.isReference() and not parameter.isConst():
+                    writable = ', True'
+                python += (parameter.getName() + 'Buffer = ' + bufferClass + parameter.getName() + ', ' +
+                        self.getElementCType(elementType) + writable + ')\n' +
+                        self.indent(2))
+                callArguments.append(parameter.getName() + 'Buffer.pointer')
+                callArguments.append(parameter.getName() + 'Buffer.size')
+            elif self.isStructureReference(parameter) and parameter.isReference():
+                # The structure must not be copied by ctypes. A pointer may be None.
+                callArguments.append('ctypes.byref(' + parameter.getName() + ')')
+            else:
+                callArguments.append(parameter.getName())
+        # The non-const methods may modify the object, so they drop the
+        # results memoized by its const methods. The cache is replaced rather
+        # than cleared, so that a const method running concurrently in another
+        # thread stores its result, which may be outdated, in the dropped cache.
+        # The structures have no cache, since their fields may be modified directly.
+        invalidation = ''
+        if self._memoize and not method.isConst() and not structure:
+            if self._sharedHandles:
+                invalidation = self.indent(2) + '_dropCache(self)\n'
+            else:
+                invalidation = self.indent(2) + 'self._cache = {}\n'
+        if returnsContainer:
+            elementCType = self.getElementCType(returnValue.getContainerElementType())
+            if returnValue.getContainerElementType() in self._structureClasses:
+                fragments.structureTypes.add(returnValue.getContainerElementType())
+            if returnValue.isReference():
+                python += ('resultSize = ctypes.c_size_t()\n' + self.indent(2) +
+                        'resultData = LIB.' + methodName + '(' +
+                        self.appendValuesToString(callArguments, '') + ', ctypes.byref(resultSize))\n' +
+                        invalidation +
+                        self.indent(2) + '# The array is a view on the vector owned by the object.\n' +
+                        self.indent(2) + 'return _nativeArray(resultData, resultSize.value, ' +
+                        elementCType + ', self' +
+                        (', True' if returnValue.isConst() else '') + ')\n\n')
+            else:
+                python += ('resultData = ctypes.c_void_p()\n' + self.indent(2) +
+                        'resultSize = ctypes.c_size_t()\n' + self.indent(2) +
+                        'vector = LIB.' + methodName + '(' +
+                        self.appendValuesToString(callArguments, '') +
+                        ', ctypes.byref(resultData), ctypes.byref(resultSize))\n' +
+                        invalidation + self.indent(2) +
+                        'return _nativeArray(resultData.value, resultSize.value, ' + elementCType +
+                        ',\n' + self.indent(4) + '_NativeVector(vector, LIB.pybindings_vector_' +
+                        returnValue.getContainerElementType() + '_delete))\n\n')
+        else:
+            call = 'LIB.' + methodName + '(' + self.appendValuesToString(callArguments, '') + ')'
+            if self.returnsWrappedObject(method):
+                owned = self.isResultOwned(className, method)
+                call = ('_wrapPointer(\'' + returnValue.getType() + '\', ' + call + ', ' +
+                        str(owned) + ', self)')
+            if self.isMemoized(method) and not structure:
+                python += ('cache = self._cache\n' +
+                        self.indent(2) + 'try:\n' +
+                        self.indent(3) + 'return cache[\'' + method.getName() + '\']\n' +
+                        self.indent(2) + 'except KeyError:\n' +
+                        self.indent(3) + 'result = ' + call + '\n' +
+                        self.indent(3) + '_memoize(cache, \'' + method.getName() +
+                        '\', result)\n' +
+                        self.indent(3) + 'return result\n\n')
+            elif invalidation:
+                if returnValue.getType() != 'void':
+                    python += ('result = ' + call + '\n' + invalidation +
+                            self.indent(2) + 'return result\n\n')
+                else:
+                    python += call + '\n' + invalidation + '\n'
+            else:
+                # If there is non-void return value, add the 'return' statement
+                # to the wrapper string.
+                if returnValue.getType() != 'void':
+                    python += 'return '
+                python += call + '\n\n'
+        fragments.wrapper += python
+
+        if self._commandBuffer and not usesContainers:
+            command = self.getCommand(className, method)
+            if command is not None:
+                fragments.commands.append(command)
+
+        if self._stressHarness:
+            returnValue = method.getReturnValue()
+            fragments.stressMethods.append((className, method.getName(),
+                self.getStressArguments(method),
+                not returnValue.isPointer() and not returnValue.isReference() and
+                not returnsStructure and not returnsContainer))
 
         # Handle unit test.
         python = (self.indent() + 'def test_' + method.getName() + '(self):\n' +
@@ -351,8 +1782,616 @@ class PyAPIWriter(object):
                 self.indent(2) + 'self.assertTrue(obj)\n' +
                 self.indent(2) + 'obj.' + method.getName() + '()\n' +
                 self.indent(2) + 'self.assertTrue(obj)\n\n')
-        with open(self._testerFilename, 'a') as fp:
-            fp.write(python)
+        fragments.tester += python
+
+    def returnsWrappedObject(self, method):
+        """
+        Return True if the Python wrapper of the CPPMethod 'method' returns
+        the wrapper of the object it returns, see getIdentityMapWrapper. The
+        structures are not handles and have no identity.
+        """
+        returnValue = method.getReturnValue()
+        return (self._identityMap and returnValue.getType() in self._classNames and
+                returnValue.getType() not in self._structureClasses and
+                not returnValue.hasNamespace() and not returnValue.getTemplateArguments() and
+                ((returnValue.isPointer() and returnValue.getNumberOfPointers() == 1) or
+                (returnValue.isReference() and not returnValue.isPointer())))
+
+    def isResultOwned(self, className, method):
+        """
+        Return True if the caller owns the object returned by pointer by the
+        CPPMethod 'method' of the class 'className', that is if the method
+        matches one of the ownedResults patterns. The patterns containing a
+        dot, like 'Stuff.clone', are matched against the qualified name of the
+        method, the others against its name only. Nothing in a C++ declaration
+        tells who owns a pointer, so the other results are borrowed.
+        """
+        if not method.getReturnValue().isPointer():
+            return False
+        for pattern in self._ownedResults:
+            name = method.getName()
+            if '.' in pattern:
+                name = className + '.' + name
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    def countsResult(self, className, method):
+        """
+        Return True if the C API function of the CPPMethod 'method' of the
+        class 'className' counts the object it returns in the accounting,
+        since its wrapper deletes it, see isResultOwned.
+        """
+        return (self._accounting and self.returnsWrappedObject(method) and
+                self.isResultOwned(className, method))
+
+    def getIdentityMapWrapper(self):
+        """
+        Return the Python code of the identity map of the wrappers.
+
+        A native object returned by a method belongs to the object the method
+        was called on, which its wrapper keeps alive, unless it is owned by
+        the caller, see isResultOwned, and its wrapper then deletes it. The wrapper created first for an address is
+        reused, with its ownership, as long as it is alive: in particular a
+        method returning its own object returns the wrapper it was called on.
+        """
+        python = ('# Wrappers of the native objects by class name and address, so that an object\n'
+                '# returned several times is always wrapped by the same Python object.\n'
+                '_WRAPPERS = weakref.WeakValueDictionary()\n'
+                '_WRAPPERS_LOCK = threading.Lock()\n\n\n'
+                'def _wrapPointer(className, pointer, owned, owner):\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Return the wrapper of the native object of the class \'className\' at\n' +
+                self.indent() + 'the address \'pointer\', creating it if there is none. A new wrapper\n' +
+                self.indent() + 'deletes the object if it is \'owned\', otherwise it keeps \'owner\' alive.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'if not pointer:\n' +
+                self.indent(2) + 'return None\n' +
+                self.indent() + 'key = (className, pointer)\n' +
+                self.indent() + 'obj = _WRAPPERS.get(key)\n' +
+                self.indent() + 'if obj is not None:\n' +
+                self.indent(2) + 'return obj\n' +
+                self.indent() + 'cls = getattr(sys.modules[__name__], className)\n' +
+                self.indent() + 'with _WRAPPERS_LOCK:\n' +
+                self.indent(2) + '# Another thread may have wrapped the object meanwhile.\n' +
+                self.indent(2) + 'obj = _WRAPPERS.get(key)\n' +
+                self.indent(2) + 'if obj is None:\n' +
+                self.indent(3) + 'obj = cls.__new__(cls)\n' +
+                self.indent(3) + 'obj._obj = pointer\n')
+        if self._memoize:
+            python += self.indent(3) + 'obj._cache = {}\n'
+        python += (self.indent(3) + 'if not owned:\n' +
+                self.indent(4) + 'obj._owned = False\n' +
+                self.indent(4) + 'obj._owner = owner\n' +
+                self.indent(3) + '_WRAPPERS[key] = obj\n' +
+                self.indent() + 'return obj\n\n\n')
+        return python
+
+    def isMemoized(self, method):
+        """
+        Return True if the Python wrapper caches the result of the CPPMethod
+        'method'. Only the zero-argument const methods are memoized, and not
+        the ones returning containers, whose arrays are views on the object,
+        structures, which may be modified, or pointers and references, which
+        may be new objects owned by the caller or change with other objects.
+        """
+        returnValue = method.getReturnValue()
+        return (self._memoize > 0 and method.isConst() and not method.hasParameters() and
+                returnValue.getType() != 'void' and not self.isMappedContainer(returnValue) and
+                not self.isStructureValue(returnValue) and not returnValue.isPointer() and
+                not returnValue.isReference())
+
+    def getMemoizationWrapper(self):
+        """Return the Python code storing the results of the memoized methods."""
+        return ('# Maximum number of results memoized by each object.\n'
+                '_MEMOIZE_SIZE = ' + str(self._memoize) + '\n\n\n'
+                'def _memoize(cache, methodName, result):\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Store the result of the method \'methodName\' in the memoization\n' +
+                self.indent() + '\'cache\' of an object, evicting the oldest result if it is full.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'if len(cache) >= _MEMOIZE_SIZE:\n' +
+                self.indent(2) + 'try:\n' +
+                self.indent(3) + 'del cache[next(iter(cache))]\n' +
+                self.indent(2) + 'except (KeyError, RuntimeError, StopIteration):\n' +
+                self.indent(3) + '# Another thread modified the cache at the same time.\n' +
+                self.indent(3) + 'pass\n' +
+                self.indent() + 'cache[methodName] = result\n\n\n' +
+                self.getCacheDropWrapper())
+
+    def getCacheDropWrapper(self):
+        """
+        Return the Python code of _dropCache, dropping the results memoized
+        by a wrapper and, with the shared handles, by all the wrappers sharing
+        its native object, since they see the same modifications.
+        """
+        if not self._sharedHandles:
+            return ('def _dropCache(obj):\n' +
+                    self.indent() + '"""Drop the results memoized by the wrapper \'obj\'."""\n' +
+                    self.indent() + 'obj._cache = {}\n\n\n')
+        return ('def _dropCache(obj):\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Drop the results memoized by the wrapper \'obj\' and by the wrappers\n' +
+                self.indent() + 'sharing its native object, see _shareWrapper.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'for wrapper in getattr(obj, \'_shares\', None) or (obj,):\n' +
+                self.indent(2) + 'wrapper._cache = {}\n\n\n')
+
+    def getShareWrapper(self):
+        """
+        Return the Python code gathering the wrappers sharing a native object,
+        see writeShare. With the identity map, a wrapper being deleted hands
+        its entry over to another wrapper sharing its object, so that
+        _wrapPointer returns that one instead of adopting the object again.
+        """
+        python = ('# Protects the creation of the groups of wrappers sharing an object.\n'
+                '_SHARES_LOCK = threading.Lock()\n\n\n'
+                'def _shareWrapper(wrapper, obj):\n' +
+                self.indent() + '"""Add the new wrapper \'obj\' to the wrappers sharing the object of \'wrapper\'."""\n' +
+                self.indent() + 'with _SHARES_LOCK:\n' +
+                self.indent(2) + 'if not wrapper._shares:\n' +
+                self.indent(3) + 'wrapper._shares = weakref.WeakSet([wrapper])\n' +
+                self.indent(2) + 'wrapper._shares.add(obj)\n' +
+                self.indent(2) + 'obj._shares = wrapper._shares\n\n\n')
+        if self._identityMap:
+            python += ('def _handOver(wrapper):\n' +
+                    self.indent() + '"""\n' +
+                    self.indent() + 'Replace the wrapper \'wrapper\', which is being deleted, by another one\n' +
+                    self.indent() + 'sharing its object in the identity map, if it is registered there.\n' +
+                    self.indent() + '"""\n' +
+                    self.indent() + 'key = (type(wrapper).__name__, wrapper._obj)\n' +
+                    self.indent() + 'with _WRAPPERS_LOCK:\n' +
+                    self.indent(2) + '# The entry is already gone if the wrapper was in a reference cycle.\n' +
+                    self.indent(2) + 'registered = _WRAPPERS.get(key)\n' +
+                    self.indent(2) + 'if registered is not None and registered is not wrapper:\n' +
+                    self.indent(3) + 'return\n' +
+                    self.indent(2) + 'for other in wrapper._shares:\n' +
+                    self.indent(3) + 'if other is not wrapper:\n' +
+                    self.indent(4) + '_WRAPPERS[key] = other\n' +
+                    self.indent(4) + 'return\n\n\n')
+        return python
+
+    def isMappedContainer(self, value):
+        """
+        Return True if the CPPValue 'value' is a contiguous container whose
+        elements can be shared with Python without copying them: numbers or
+        structures, see isStructureClass.
+        """
+        return (value.isContiguousContainer() and not value.isPointer() and
+                (value.getContainerElementType() in CONTAINER_ELEMENT_CTYPES or
+                value.getContainerElementType() in self._structureClasses))
+
+    def isStructureClass(self, class_):
+        """
+        Return True if the CPPClass 'class_' is a plain old data class whose
+        members all have a ctypes equivalent, so that it can be wrapped by a
+        ctypes structure.
+        """
+        return (class_.isPOD() and '::' not in class_.getName() and
+                all(member.getType() in STRUCTURE_FIELD_CTYPES
+                for member in class_.getMembers() if not member.isStatic()))
+
+    def isStructureValue(self, value):
+        """
+        Return True if the CPPValue 'value' is a structure, see
+        isStructureClass, passed by value or by const reference. It is then
+        passed by value to the C API.
+        """
+        return (value.getType() in self._structureClasses and not value.hasNamespace() and
+                not value.getTemplateArguments() and not value.isPointer() and
+                (not value.isReference() or value.isConst()))
+
+    def isStructureReference(self, value):
+        """
+        Return True if the CPPValue 'value' is a structure, see
+        isStructureClass, passed by non-const reference or by pointer, so
+        that the C++ method may modify it. The C API gets its address.
+        """
+        return (value.getType() in self._structureClasses and not value.hasNamespace() and
+                not value.getTemplateArguments() and
+                ((value.isReference() and not value.isConst() and not value.isPointer()) or
+                (value.isPointer() and value.getNumberOfPointers() == 1 and
+                not value.isReference())))
+
+    def getFieldCType(self, member):
+        """Return the Python source of the ctypes type of the CPPMember 'member'."""
+        ctype = STRUCTURE_FIELD_CTYPES[member.getType()]
+        if member.getArraySize() is not None:
+            ctype += ' * ' + str(member.getArraySize())
+        return ctype
+
+    def getElementCType(self, elementType):
+        """
+        Return the Python source of the ctypes type of the elements of the
+        mapped containers of 'elementType', see isMappedContainer.
+        """
+        if elementType in self._structureClasses:
+            return elementType
+        return CONTAINER_ELEMENT_CTYPES[elementType]
+
+    def usesContainers(self, method):
+        """Return True if the CPPMethod 'method' takes or returns mapped containers."""
+        values = [method.getReturnValue()] + method.getParameters()
+        return any(self.isMappedContainer(value) for value in values)
+
+    def getCParameters(self, parameter):
+        """
+        Return the list of the C API parameter declarations corresponding
+        to the CPPValue 'parameter' of a method.
+        """
+        if self.isStructureValue(parameter):
+            return [parameter.getType() + ' ' + parameter.getName()]
+        if not self.isMappedContainer(parameter):
+            return [str(parameter)]
+        elementType = parameter.getContainerElementType()
+        if parameter.isReference() and not parameter.isConst():
+            # The vector may be modified, its content is copied back.
+            data = elementType + '* ' + parameter.getName() + 'Data'
+        else:
+            data = 'const ' + elementType + '* ' + parameter.getName() + 'Data'
+        return [data, 'size_t ' + parameter.getName() + 'Size']
+
+    def getContainerMethodBody(self, method, call):
+        """
+        Return the end of the C API implementation of the CPPMethod 'method',
+        which takes or returns contiguous containers, with 'call' the call of
+        the C++ method. The null object test is already written.
+
+        The input vectors are built from the data in one bulk copy since a
+        std::vector cannot use memory it does not own. The non-const reference
+        vectors are copied back, up to the size of the given data.
+        """
+        returnValue = method.getReturnValue()
+        body = ''
+        for parameter in method.getParameters():
+            if self.isMappedContainer(parameter):
+                name = parameter.getName()
+                body += ('std::vector<' + parameter.getContainerElementType() + '> ' + name +
+                        '(' + name + 'Data, ' + name + 'Data + ' + name + 'Size);\n' + self.indent())
+
+        if self.isMappedContainer(returnValue):
+            vectorType = 'std::vector<' + returnValue.getContainerElementType() + '>'
+            if returnValue.isReference():
+                body += 'const ' + vectorType + '& result = ' + call + ';\n'
+            else:
+                body += vectorType + '* result = new ' + vectorType + '(' + call + ');\n'
+        elif returnValue.getType() != 'void':
+            body += str(returnValue) + ' result = ' + call + ';\n'
+        else:
+            body += call + ';\n'
+
+        for parameter in method.getParameters():
+            if (self.isMappedContainer(parameter) and parameter.isReference() and
+                    not parameter.isConst()):
+                name = parameter.getName()
+                # The parentheses keep a min macro, like the one of windows.h,
+                # from being expanded.
+                body += (self.indent() + 'std::copy(' + name + '.begin(), ' + name +
+                        '.begin() + (std::min)(' + name + '.size(), ' + name + 'Size), ' +
+                        name + 'Data);\n')
+
+        if self.isMappedContainer(returnValue):
+            if returnValue.isReference():
+                body += (self.indent() + '*resultSize = result.size();\n' +
+                        self.indent() + 'return result.empty() ? NULL : &result[0];\n')
+            else:
+                body += (self.indent() + '*resultSize = result->size();\n' +
+                        self.indent() + '*resultData = result->empty() ? NULL : &(*result)[0];\n' +
+                        self.indent() + 'return result;\n')
+        elif returnValue.getType() != 'void':
+            body += self.indent() + 'return result;\n'
+        return body + '}\n\n'
+
+    def getContainerWrapper(self):
+        """
+        Return the Python code exchanging the contiguous containers with
+        the C API without copying them.
+        """
+        return ('try:\n' +
+                self.indent() + 'import numpy\n'
+                'except ImportError:\n' +
+                self.indent() + 'numpy = None\n\n\n'
+                'class _NativeBuffer(object):\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Pointer and size of the memory of a sequence passed to a C++ vector.\n' +
+                self.indent() + 'Contiguous arrays of the right type, like NumPy arrays or array.array,\n' +
+                self.indent() + 'are passed in place, other sequences are converted. The sequences\n' +
+                self.indent() + 'written by the C++ method, if \'writable\', cannot be converted.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'def __init__(self, values, ctype, writable=False):\n' +
+                self.indent(2) + 'if numpy is not None:\n' +
+                self.indent(3) + '# This does not copy an array which is already suitable.\n' +
+                self.indent(3) + 'self._values = numpy.ascontiguousarray(values, dtype=ctype)\n' +
+                self.indent(3) + 'if writable and (self._values is not values or '
+                'not values.flags.writeable):\n' +
+                self.indent(4) + 'raise TypeError(\'Expected a writable contiguous array of \' + '
+                'ctype.__name__)\n' +
+                self.indent(3) + 'self.pointer = self._values.ctypes.data_as(ctypes.POINTER(ctype))\n' +
+                self.indent(3) + 'self.size = ctypes.c_size_t(self._values.size)\n' +
+                self.indent(3) + 'return\n' +
+                self.indent(2) + 'try:\n' +
+                self.indent(3) + 'view = memoryview(values)\n' +
+                self.indent(3) + 'if view.format != ctype._type_:\n' +
+                self.indent(4) + 'raise TypeError(\'Not an array of \' + ctype.__name__)\n' +
+                self.indent(3) + 'self._values = (ctype * len(view)).from_buffer(view)\n' +
+                self.indent(2) + 'except (TypeError, ValueError):\n' +
+                self.indent(3) + 'if writable:\n' +
+                self.indent(4) + 'raise TypeError(\'Expected a writable contiguous array of \' + '
+                'ctype.__name__)\n' +
+                self.indent(3) + 'self._values = (ctype * len(values))(*values)\n' +
+                self.indent(2) + 'self.pointer = ctypes.cast(self._values, ctypes.POINTER(ctype))\n' +
+                self.indent(2) + 'self.size = ctypes.c_size_t(len(self._values))\n\n\n' +
+                (self.getStructureBufferWrapper() if self._structureClasses else '') +
+                'class _NativeVector(object):\n' +
+                self.indent() + '"""Owner of a std::vector returned by value by the C API."""\n' +
+                self.indent() + 'def __init__(self, vector, delete):\n' +
+                self.indent(2) + 'self._vector = vector\n' +
+                self.indent(2) + 'self._delete = delete\n\n' +
+                self.indent() + 'def __del__(self):\n' +
+                self.indent(2) + 'self._delete(ctypes.c_void_p(self._vector))\n\n\n'
+                'def _nativeArray(address, size, ctype, owner, readonly=False):\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Return a NumPy array, or a memoryview if NumPy is not available, on\n' +
+                self.indent() + 'the \'size\' values of type \'ctype\' at \'address\' without copying them.\n' +
+                self.indent() + 'The array keeps alive \'owner\', the object owning this memory, and\n' +
+                self.indent() + 'cannot be written if \'readonly\', like the values of a const reference.\n' +
+                self.indent() + 'A view on a vector owned by an object dangles once the object\n' +
+                self.indent() + 'reallocates the vector, for example when a method resizes it.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'if size:\n' +
+                self.indent(2) + 'buffer = (ctype * size).from_address(address)\n' +
+                self.indent() + 'else:\n' +
+                self.indent(2) + 'buffer = (ctype * 0)()\n' +
+                self.indent() + 'buffer._owner = owner\n' +
+                self.indent() + 'if numpy is not None:\n' +
+                self.indent(2) + 'array = numpy.frombuffer(buffer, dtype=ctype)\n' +
+                self.indent(2) + 'array.flags.writeable = not readonly\n' +
+                self.indent(2) + 'return array\n' +
+                (self.indent() + 'if issubclass(ctype, ctypes.Structure):\n' +
+                self.indent(2) + '# memoryview does not handle the formats of the structures.\n' +
+                self.indent(2) + 'return buffer\n' if self._structureClasses else '') +
+                self.indent() + 'view = memoryview(buffer).cast(\'B\').cast(ctype._type_)\n' +
+                self.indent() + 'return view.toreadonly() if readonly else view\n\n\n')
+
+    def getStructureBufferWrapper(self):
+        """
+        Return the Python code passing the sequences of structures to the
+        C API, see getContainerWrapper.
+        """
+        return ('class _StructureBuffer(object):\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Pointer and size of the memory of a sequence of structures passed to a\n' +
+                self.indent() + 'C++ vector. NumPy structured arrays and ctypes arrays of the structure\n' +
+                self.indent() + 'are passed in place, other sequences are copied.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'def __init__(self, values, ctype):\n' +
+                self.indent(2) + 'if numpy is not None and isinstance(values, numpy.ndarray):\n' +
+                self.indent(3) + '# This does not copy an array which is already suitable.\n' +
+                self.indent(3) + 'self._values = numpy.ascontiguousarray(values, dtype=ctype)\n' +
+                self.indent(3) + 'self.pointer = self._values.ctypes.data_as(ctypes.POINTER(ctype))\n' +
+                self.indent(3) + 'self.size = ctypes.c_size_t(self._values.size)\n' +
+                self.indent(3) + 'return\n' +
+                self.indent(2) + 'if isinstance(values, ctypes.Array) and values._type_ is ctype:\n' +
+                self.indent(3) + 'self._values = values\n' +
+                self.indent(2) + 'else:\n' +
+                self.indent(3) + 'self._values = (ctype * len(values))(*values)\n' +
+                self.indent(2) + 'self.pointer = ctypes.cast(self._values, ctypes.POINTER(ctype))\n' +
+                self.indent(2) + 'self.size = ctypes.c_size_t(len(self._values))\n\n\n')
+
+    def getStructureWrapper(self):
+        """
+        Return the Python code setting the fields of the structures, see
+        writeStructure.
+
+        The tags are sorted by name, so the order of the members of the C++
+        classes is only known from their offsets in the library.
+        """
+        return ('def _setLayout(structure, layout):\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'Set the fields of the ctypes structure \'structure\' in the order of the\n' +
+                self.indent() + 'members of its C++ class, whose offsets and size are returned by\n' +
+                self.indent() + '\'layout\', and check that the layouts are the same.\n' +
+                self.indent() + '"""\n' +
+                self.indent() + 'offsets = (ctypes.c_size_t * len(structure._members))()\n' +
+                self.indent() + 'size = layout(offsets)\n' +
+                self.indent() + 'order = sorted(range(len(offsets)), key=lambda index: offsets[index])\n' +
+                self.indent() + 'structure._fields_ = [structure._members[index] for index in order]\n' +
+                self.indent() + 'expectedOffsets = [getattr(structure, name).offset '
+                'for name, ctype in structure._fields_]\n' +
+                self.indent() + 'if (size != ctypes.sizeof(structure) or\n' +
+                self.indent(3) + '[offsets[index] for index in order] != expectedOffsets):\n' +
+                self.indent(2) + 'raise ImportError(\'The layout of \' + structure.__name__ +\n' +
+                self.indent(4) + '\' does not match the one of its C++ class.\')\n\n\n')
+
+    def getCommandSlot(self, value):
+        """
+        Return the field of a PyBindingsSlot holding the CPPValue 'value' in
+        the command buffer: 'integer', 'real' or 'pointer'. Return None if
+        the value cannot be held by a slot.
+        """
+        if value.isPointer() and not value.isReference():
+            return 'pointer'
+        if value.isPointer() or value.hasNamespace() or (value.isReference() and
+                not value.isConst()):
+            return None
+        if value.getType() in COMMAND_INTEGER_TYPES:
+            return 'integer'
+        if value.getType() in COMMAND_REAL_TYPES:
+            return 'real'
+        return None
+
+    def getCommand(self, className, method):
+        """
+        Return the command buffer entry of the CPPMethod 'method', as a tuple
+        (className, methodName, argumentSlots, resultSlot, mutating, statement),
+        or None if the method cannot be recorded.
+
+        The slots are the PyBindingsSlot fields of the arguments and of the
+        result, which is None for void methods. The pointers and references
+        are returned as addresses, like the methods of the Python wrapper do.
+        mutating tells if the method is not const and the statement is the C++
+        code executing a recorded call.
+        """
+        argumentSlots = []
+        arguments = ['static_cast<' + className + '*>(command.object)']
+        for index, parameter in enumerate(method.getParameters()):
+            slot = self.getCommandSlot(parameter)
+            if slot is None:
+                return None
+            argumentSlots.append(slot)
+            argument = 'command.arguments[' + str(index) + '].' + slot
+            if slot == 'pointer':
+                arguments.append('static_cast<' + parameter.getTypeString() + '>(' + argument + ')')
+            elif parameter.getType() == 'bool':
+                arguments.append(argument + ' != 0')
+            else:
+                arguments.append('static_cast<' + parameter.getType() + '>(' + argument + ')')
+        call = (className + '_' + method.getName() + '(' +
+                self.appendValuesToString(arguments, '') + ')')
+
+        returnValue = method.getReturnValue()
+        if self.isStructureValue(returnValue):
+            # The C API returns the structures by value, which no slot can hold.
+            return None
+        if returnValue.isReference():
+            resultSlot = 'pointer'
+            statement = 'command.result.pointer = (void*)&' + call + ';'
+        elif returnValue.isPointer():
+            resultSlot = 'pointer'
+            statement = 'command.result.pointer = (void*)' + call + ';'
+        elif returnValue.getType() == 'void':
+            resultSlot = None
+            statement = call + ';'
+        else:
+            resultSlot = self.getCommandSlot(returnValue)
+            if resultSlot is None:
+                return None
+            statement = 'command.result.' + resultSlot + ' = ' + call + ';'
+        return (className, method.getName(), tuple(argumentSlots), resultSlot,
+                not method.isConst(), statement)
+
+    def getCommandArgumentCount(self):
+        """Return the number of argument slots of a PyBindingsCommand."""
+        # An empty array is not valid, so there is at least one slot.
+        return max([1] + [len(command[2]) for command in self._commands])
+
+    def getCommandInterpreter(self):
+        """
+        Return the C++ code of pybindings_execute, which executes in order the
+        'count' recorded calls of 'commands' and stores their results in them.
+        It returns the number of executed commands, which is less than 'count'
+        if an unknown opcode was met.
+        """
+        interpreter = ('int pybindings_execute(PyBindingsCommand* commands, int count)\n'
+                '{\n' +
+                self.indent() + 'for(int i = 0; i < count; ++i)\n' +
+                self.indent() + '{\n' +
+                self.indent(2) + 'PyBindingsCommand& command = commands[i];\n' +
+                self.indent(2) + 'switch(command.opcode)\n' +
+                self.indent(2) + '{\n')
+        for opcode, command in enumerate(self._commands):
+            interpreter += (self.indent(2) + 'case ' + str(opcode) + ':\n' +
+                    self.indent(3) + command[5] + '\n' +
+                    self.indent(3) + 'break;\n')
+        interpreter += (self.indent(2) + 'default:\n' +
+                self.indent(3) + 'return i;\n' +
+                self.indent(2) + '}\n' +
+                self.indent() + '}\n' +
+                self.indent() + 'return count;\n'
+                '}\n\n')
+        return interpreter
+
+    def getCommandBufferWrapper(self):
+        """
+        Return the Python code of the command buffer, recording calls of the
+        methods of the wrappers and executing them with pybindings_execute.
+        """
+        wrapper = ('class PyBindingsSlot(ctypes.Union):\n' +
+                self.indent() + '_fields_ = [(\'integer\', ctypes.c_int64),\n' +
+                self.indent(3) + '(\'real\', ctypes.c_double),\n' +
+                self.indent(3) + '(\'pointer\', ctypes.c_void_p)]\n\n\n'
+                'class PyBindingsCommand(ctypes.Structure):\n' +
+                self.indent() + '_fields_ = [(\'opcode\', ctypes.c_int),\n' +
+                self.indent(3) + '(\'object\', ctypes.c_void_p),\n' +
+                self.indent(3) + '(\'arguments\', PyBindingsSlot * ' +
+                str(self.getCommandArgumentCount()) + '),\n' +
+                self.indent(3) + '(\'result\', PyBindingsSlot)]\n\n\n'
+                '# Methods which can be recorded in a CommandBuffer:\n'
+                '# (className, methodName) -> (opcode, argumentSlots, resultSlot, mutating).\n'
+                '_COMMANDS = {\n')
+        for opcode, command in enumerate(self._commands):
+            className, methodName, argumentSlots, resultSlot, mutating, statement = command
+            wrapper += (self.indent() + repr((className, methodName)) + ': (' + str(opcode) +
+                    ', ' + repr(argumentSlots) + ', ' + repr(resultSlot) + ', ' +
+                    repr(mutating) + '),\n')
+        return wrapper + '}\n' + COMMAND_BUFFER_WRAPPER
+
+    def getStressArguments(self, method):
+        """
+        Return the Python source of a tuple of default arguments allowing the
+        stress harness to call the CPPMethod 'method', or None if some of its
+        parameters are not plain numeric values.
+        """
+        defaults = {'bool': 'False', 'char': '0', 'short': '0', 'int': '0', 'long': '0',
+                'unsigned': '0', 'signed': '0', 'size_t': '0', 'float': '0.0', 'double': '0.0'}
+        arguments = []
+        for parameter in method.getParameters():
+            if (parameter.isPointer() or parameter.hasNamespace() or
+                    parameter.getType() not in defaults):
+                return None
+            arguments.append(defaults[parameter.getType()])
+        if len(arguments) == 1:
+            return '(' + arguments[0] + ',)'
+        return '(' + ', '.join(arguments) + ')'
+
+    def writeStressHarness(self):
+        """
+        Write the stress harness exercising the methods of the Python wrapper.
+
+        Every method that can be called with default arguments is run from
+        1..N threads and processes, each one working on its own object, and
+        the harness reports its throughput and scaling efficiency. Each
+        measurement runs in a child process so that a crash is reported
+        instead of stopping the whole run. Since the objects are independent,
+        the results must be the same as in a serial run: a difference means
+        that some hidden shared state is raced.
+        """
+        print('PyAPIWriter: writing stress harness to ' + self._stressHarnessFilename + '.')
+        if self._wrapperPackage:
+            wrapperModule = os.path.basename(self._wrapperPackage)
+        else:
+            wrapperModule = os.path.splitext(os.path.basename(self._wrapperFilename))[0]
+        with self._openOutput(self._stressHarnessFilename, 'w') as fp:
+            fp.write('#!/usr/bin/python\n'
+                    '"""\nFile automatically generated by the pybindings project.\n'
+                    'This file implements a concurrency stress and scaling harness for\n'
+                    'the Python wrapper of the C++ objects exported in the ' +
+                    self._libraryName + ' library.\n\n'
+                    'Run it with: python ' + os.path.basename(self._stressHarnessFilename) +
+                    ' [--max-workers N] [--calls N]\n"""\n'
+                    'import argparse\n'
+                    'import concurrent.futures\n'
+                    'import multiprocessing\n'
+                    'import subprocess\n'
+                    'import sys\n'
+                    'import threading\n'
+                    'import time\n\n'
+                    'import ' + wrapperModule + ' as WRAPPER\n\n'
+                    '# Methods to stress:\n'
+                    '# (className, methodName) -> (arguments, compareResults).\n'
+                    'METHODS = {\n')
+            for className, methodName, arguments, compareResults in self._stressMethods:
+                if arguments is not None:
+                    fp.write(self.indent() + '(\'' + className + '\', \'' + methodName + '\'): (' +
+                            arguments + ', ' + str(compareResults) + '),\n')
+            fp.write('}\n\n'
+                    '# Methods which cannot be called with default arguments.\n'
+                    'SKIPPED = [\n')
+            for className, methodName, arguments, compareResults in self._stressMethods:
+                if arguments is None:
+                    fp.write(self.indent() + '(\'' + className + '\', \'' + methodName + '\'),\n')
+            fp.write(']\n\n')
+            fp.write(STRESS_HARNESS_RUNNER)
 
     def appendValuesToString(self, values, string):
         """
@@ -367,11 +2406,11 @@ class PyAPIWriter(object):
             raise Exception('The \'values\' collection must not be empty.')
         else:
             itValue = values.__iter__()
-            value = itValue.next()
+            value = next(itValue)
             while True:
                 string += str(value)
                 try:
-                    value = itValue.next()
+                    value = next(itValue)
                 except StopIteration:
                     break
                 else:
@@ -388,6 +2427,19 @@ class PyAPIWriter(object):
         string += 'if(obj == NULL) nullObjectError(__FUNCTION__);'
         return string
 
+    def appendLockToString(self, string, obj, exclusive):
+        """
+        Append the locking of the object 'obj' to the string, when the thread
+        safe mode is enabled. The lock is released at the end of the block.
+
+        Remember that strings are imutable, so in fact returns a new
+        string with the appended values.
+        """
+        if self._threadSafe:
+            string += ('\n' + self.indent() + 'PyBindingsGuard guard(' + obj + ', ' +
+                    ('true' if exclusive else 'false') + ');')
+        return string
+
     def indent(self, count=1):
         """
         Return an indentation string corresponding to 'count',
@@ -396,3 +2448,431 @@ class PyAPIWriter(object):
         unitIndent = '    '
         return unitIndent * count
 
+
+
+# Writer and classes rendered by a worker process of PyAPIWriter.renderClasses.
+_renderWorkerJob = None
+
+
+def _initializeRenderWorker(writer, classes):
+    global _renderWorkerJob
+    _renderWorkerJob = (writer, classes)
+
+
+def _renderClassAt(index):
+    writer, classes = _renderWorkerJob
+    return writer.renderClass(classes[index])
+
+
+class _OutputFile(object):
+    """Output file of a PyAPIWriter appending its text to a list of chunks."""
+    def __init__(self, chunks):
+        self.write = chunks.append
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+class ClassFragments(object):
+    """
+    Pieces of the outputs of a PyAPIWriter corresponding to one CPPClass.
+
+    The classes are rendered independently of each other into fragments,
+    which are then merged in order into the files.
+    """
+    def __init__(self, className):
+        self.className = className
+        # Text of the C API header, the C API implementation, the Python
+        # wrapper class, the module level statements following it and
+        # the unit test class.
+        self.declaration = ''
+        self.implementation = ''
+        self.wrapper = ''
+        self.prototypes = ''
+        self.tester = ''
+        # Counter of the number of constructors written for the class.
+        self.writtenConstructors = 0
+        # C API name of the copy constructor of the class, if any.
+        self.copyConstructorName = None
+        # Methods exercised by the stress harness, see PyAPIWriter.
+        self.stressMethods = []
+        # Element types of the vectors returned by value.
+        self.vectorElementTypes = set()
+        # Structures used by the Python wrapper, see PyAPIWriter.isStructureClass.
+        self.structureTypes = set()
+        # Methods which can be recorded in the command buffer, see PyAPIWriter.
+        self.commands = []
+        # Context the class was rendered in, see PyAPIWriter.getRenderingContext.
+        self.context = None
+
+
+# Include of the Windows API, without its min and max macros which break
+# std::min and std::max, and without its rarely used parts.
+WINDOWS_INCLUDE = ('#ifndef NOMINMAX\n'
+        '#define NOMINMAX\n'
+        '#endif\n'
+        '#ifndef WIN32_LEAN_AND_MEAN\n'
+        '#define WIN32_LEAN_AND_MEAN\n'
+        '#endif\n'
+        '#include <windows.h>\n')
+
+# Types which can be used in the C API header without any include.
+BUILTIN_TYPES = set(['void', 'bool', 'char', 'wchar_t', 'short', 'int', 'long', 'float',
+        'double', 'signed', 'unsigned', 'const'])
+
+# Headers declaring the other types which do not need the C++ headers.
+DECLARATION_HEADERS = {
+    'size_t': '<stddef.h>',
+    'int8_t': '<stdint.h>',
+    'int16_t': '<stdint.h>',
+    'int32_t': '<stdint.h>',
+    'int64_t': '<stdint.h>',
+    'uint8_t': '<stdint.h>',
+    'uint16_t': '<stdint.h>',
+    'uint32_t': '<stdint.h>',
+    'uint64_t': '<stdint.h>',
+    'std::size_t': '<cstddef>',
+    'std::string': '<string>',
+    'std::wstring': '<string>',
+    'std::vector': '<vector>',
+    'std::list': '<list>',
+    'std::deque': '<deque>',
+    'std::map': '<map>',
+    'std::set': '<set>',
+    'std::pair': '<utility>',
+    'std::complex': '<complex>',
+}
+
+# ctypes types of the C types passed by value to the functions of the dispatch table.
+FUNCTION_CTYPES = {
+    'void': 'None',
+    'bool': 'ctypes.c_bool',
+    'char': 'ctypes.c_byte',
+    'signed char': 'ctypes.c_byte',
+    'unsigned char': 'ctypes.c_ubyte',
+    'short': 'ctypes.c_short',
+    'unsigned short': 'ctypes.c_ushort',
+    'int': 'ctypes.c_int',
+    'signed': 'ctypes.c_int',
+    'unsigned': 'ctypes.c_uint',
+    'unsigned int': 'ctypes.c_uint',
+    'long': 'ctypes.c_long',
+    'unsigned long': 'ctypes.c_ulong',
+    'float': 'ctypes.c_float',
+    'double': 'ctypes.c_double',
+    'size_t': 'ctypes.c_size_t',
+    'std::size_t': 'ctypes.c_size_t',
+    'int8_t': 'ctypes.c_int8',
+    'int16_t': 'ctypes.c_int16',
+    'int32_t': 'ctypes.c_int32',
+    'int64_t': 'ctypes.c_int64',
+    'uint8_t': 'ctypes.c_uint8',
+    'uint16_t': 'ctypes.c_uint16',
+    'uint32_t': 'ctypes.c_uint32',
+    'uint64_t': 'ctypes.c_uint64',
+}
+
+# Words of these types, which cannot be the name of a parameter.
+FUNCTION_CTYPES_WORDS = set(word for cType in FUNCTION_CTYPES for word in cType.split())
+
+# ctypes types of the fields of the structures, see PyAPIWriter.isStructureClass.
+STRUCTURE_FIELD_CTYPES = dict((cType, ctype) for cType, ctype in FUNCTION_CTYPES.items()
+        if cType != 'void')
+
+# ctypes types of the elements of the C++ vectors mapped to NumPy arrays.
+CONTAINER_ELEMENT_CTYPES = {
+    'short': 'ctypes.c_short',
+    'int': 'ctypes.c_int',
+    'long': 'ctypes.c_long',
+    'float': 'ctypes.c_float',
+    'double': 'ctypes.c_double',
+    'size_t': 'ctypes.c_size_t',
+    'int8_t': 'ctypes.c_int8',
+    'int16_t': 'ctypes.c_int16',
+    'int32_t': 'ctypes.c_int32',
+    'int64_t': 'ctypes.c_int64',
+    'uint8_t': 'ctypes.c_uint8',
+    'uint16_t': 'ctypes.c_uint16',
+    'uint32_t': 'ctypes.c_uint32',
+    'uint64_t': 'ctypes.c_uint64',
+}
+
+# Types of the values held by the slots of the command buffer.
+COMMAND_INTEGER_TYPES = set(['bool', 'char', 'short', 'int', 'long', 'unsigned', 'signed',
+        'size_t', 'int8_t', 'int16_t', 'int32_t', 'int64_t', 'uint8_t', 'uint16_t',
+        'uint32_t', 'uint64_t'])
+COMMAND_REAL_TYPES = set(['float', 'double'])
+
+# Static part of the command buffer written by PyAPIWriter.getCommandBufferWrapper.
+COMMAND_BUFFER_WRAPPER = '''
+# Layout of the PyBindingsCommand, which are packed with the struct module
+# since it is much faster than setting the fields of ctypes structures.
+_COMMAND_SIZE = ctypes.sizeof(PyBindingsCommand)
+_RESULT_OFFSET = PyBindingsCommand.result.offset
+_SLOT_FORMATS = {'integer': 'q', 'real': 'd', 'pointer': 'P', None: None}
+# Format of the result of each opcode.
+_RESULT_FORMATS = dict((opcode, _SLOT_FORMATS[resultSlot])
+        for opcode, argumentSlots, resultSlot, mutating in _COMMANDS.values())
+
+
+class _CommandRecorder(object):
+    """Object recording the method calls of a wrapper in a CommandBuffer."""
+    def __init__(self, commands, obj):
+        self._commands = commands
+        self._obj = obj
+
+    def __getattr__(self, methodName):
+        record = functools.partial(self._commands.record, self._obj, methodName)
+        # Cache the method so that __getattr__ is not called anymore.
+        setattr(self, methodName, record)
+        return record
+
+
+class CommandBuffer(object):
+    """
+    Buffer recording calls of the methods of the wrappers, which are then
+    executed by the native library in a single call instead of one call
+    per method. For instance:
+
+        with CommandBuffer() as commands:
+            commands.record(obj, 'setInteger', 3)
+            message = commands.on(obj).getMessage()
+        print(commands.getResult(message))
+
+    The calls are executed when leaving the 'with' block, or by execute().
+    Only the methods taking and returning plain numbers or pointers can be
+    recorded, see _COMMANDS.
+
+    The recorded calls are kept after their execution, so that a sequence
+    recorded once can be executed again without any Python work per call.
+    Use clear() to record a new sequence.
+    """
+    def __init__(self, capacity=64):
+        self._data = bytearray(max(capacity, 1) * _COMMAND_SIZE)
+        self._count = 0
+        self._executed = 0
+        # Packing struct, opcode, number of arguments and mutating flag of
+        # the methods already recorded, by wrapper type and method name.
+        self._entries = {}
+        # Objects with a memoization cache modified by the recorded calls,
+        # whose caches are dropped after each execution.
+        self._modifiedObjects = []
+
+    def __len__(self):
+        return self._count
+
+    def on(self, obj):
+        """Return an object recording the calls of the methods of the wrapper 'obj'."""
+        return _CommandRecorder(self, obj)
+
+    def _getEntry(self, type_, methodName):
+        for class_ in type_.__mro__:
+            command = _COMMANDS.get((class_.__name__, methodName))
+            if command is not None:
+                break
+        else:
+            raise ValueError('%s.%s cannot be recorded in a command buffer.' %
+                    (type_.__name__, methodName))
+        opcode, argumentSlots, resultSlot, mutating = command
+        packer = struct.Struct('@iP' + ''.join(_SLOT_FORMATS[slot] for slot in argumentSlots))
+        entry = (packer, opcode, len(argumentSlots), mutating)
+        self._entries[(type_, methodName)] = entry
+        return entry
+
+    def record(self, obj, methodName, *arguments):
+        """
+        Record the call of the method 'methodName' of the wrapper 'obj' with
+        'arguments', and return its index to get its result with getResult.
+        """
+        entry = self._entries.get((type(obj), methodName))
+        if entry is None:
+            entry = self._getEntry(type(obj), methodName)
+        packer, opcode, argumentCount, mutating = entry
+        if len(arguments) != argumentCount:
+            raise TypeError('%s() takes %d arguments (%d given)' %
+                    (methodName, argumentCount, len(arguments)))
+        index = self._count
+        if (index + 1) * _COMMAND_SIZE > len(self._data):
+            self._data.extend(bytes(len(self._data)))
+        packer.pack_into(self._data, index * _COMMAND_SIZE, opcode, obj._obj or 0, *arguments)
+        self._count = index + 1
+        if mutating and hasattr(obj, '_cache'):
+            self._modifiedObjects.append(obj)
+        return index
+
+    def execute(self):
+        """Execute all the recorded calls with a single call of the native library."""
+        commands = (PyBindingsCommand * self._count).from_buffer(self._data)
+        self._executed = LIB.pybindings_execute(commands, self._count)
+        for obj in self._modifiedObjects:
+            _dropCache(obj)
+        if self._executed != self._count:
+            raise RuntimeError('Unknown opcode %d in the command buffer.' %
+                    struct.unpack_from('i', self._data, self._executed * _COMMAND_SIZE)[0])
+
+    def getResult(self, index):
+        """
+        Return the result of the call recorded at 'index' in its last execution,
+        or None if the method is void.
+        """
+        if not 0 <= index < self._executed:
+            raise RuntimeError('The command %d has not been executed.' % index)
+        offset = index * _COMMAND_SIZE
+        resultFormat = _RESULT_FORMATS[struct.unpack_from('i', self._data, offset)[0]]
+        if resultFormat is None:
+            return None
+        return struct.unpack_from(resultFormat, self._data, offset + _RESULT_OFFSET)[0]
+
+    def clear(self):
+        """Forget all the recorded calls."""
+        self._count = 0
+        self._executed = 0
+        self._modifiedObjects = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.execute()
+        else:
+            self.clear()
+        return False
+
+
+'''
+
+# Static part of the stress harness written by PyAPIWriter.writeStressHarness.
+STRESS_HARNESS_RUNNER = '''
+def runCalls(className, methodName, arguments, calls):
+    """Call the method 'calls' times on a fresh object and return the results."""
+    obj = getattr(WRAPPER, className)()
+    method = getattr(obj, methodName)
+    return [method(*arguments) for i in range(calls)]
+
+
+def measure(className, methodName, mode, workers, calls):
+    """
+    Run the method from 'workers' threads or processes, each one working on
+    its own object. Return the elapsed time and whether the results differ
+    from the ones of a serial run.
+    """
+    arguments, compareResults = METHODS[(className, methodName)]
+    baseline = runCalls(className, methodName, arguments, calls)
+    jobs = [(className, methodName, arguments, calls)] * workers
+    if mode == 'threads':
+        results = [None] * workers
+
+        def work(index):
+            results[index] = runCalls(*jobs[index])
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+        begin = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - begin
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            # Make sure all the workers are started before timing.
+            list(pool.map(abs, range(workers)))
+            begin = time.time()
+            futures = [pool.submit(runCalls, *job) for job in jobs]
+            results = [future.result() for future in futures]
+            elapsed = time.time() - begin
+    if compareResults:
+        raced = any(result != baseline for result in results)
+    else:
+        # The results are addresses inside each object or arrays, only
+        # check that all the workers completed.
+        raced = any(result is None for result in results)
+    return elapsed, raced
+
+
+def workerCounts(maxWorkers):
+    """Return 1, 2, 4... up to maxWorkers included."""
+    counts = []
+    count = 1
+    while count < maxWorkers:
+        counts.append(count)
+        count *= 2
+    counts.append(maxWorkers)
+    return counts
+
+
+def runMeasure(className, methodName, mode, workers, options):
+    """
+    Run one measurement in a child process so that a crash does not stop the
+    harness. Return (throughput, flag) where flag is None if all went well.
+    """
+    cmd = [sys.executable, __file__, '--calls', str(options.calls),
+            '--measure', className, methodName, mode, str(workers)]
+    try:
+        child = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                timeout=options.timeout, universal_newlines=True)
+    except subprocess.TimeoutExpired:
+        return None, 'TIMEOUT (deadlock?)'
+    if child.returncode < 0:
+        return None, 'CRASH (signal ' + str(-child.returncode) + ')'
+    if child.returncode != 0:
+        lines = child.stderr.strip().splitlines() or ['exit code ' + str(child.returncode)]
+        return None, 'ERROR (' + lines[-1] + ')'
+    elapsed, raced = child.stdout.split()
+    throughput = workers * options.calls / max(float(elapsed), 1e-9)
+    if raced == 'True':
+        return throughput, 'RACE (results differ from the serial run)'
+    return throughput, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress the Python bindings '
+            'from several threads and processes.')
+    parser.add_argument('--max-workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--calls', type=int, default=10000,
+            help='number of calls of the method per worker')
+    parser.add_argument('--timeout', type=float, default=60.0,
+            help='maximum duration of one measurement in seconds')
+    parser.add_argument('--measure', nargs=4, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.measure:
+        className, methodName, mode, workers = options.measure
+        elapsed, raced = measure(className, methodName, mode, int(workers), options.calls)
+        print(str(elapsed) + ' ' + str(raced))
+        return 0
+
+    problems = []
+    for className, methodName in sorted(METHODS):
+        for mode in ('threads', 'processes'):
+            single = None
+            for workers in workerCounts(options.max_workers):
+                throughput, flag = runMeasure(className, methodName, mode, workers, options)
+                line = '%s.%s [%s] workers=%d' % (className, methodName, mode, workers)
+                if throughput is not None:
+                    if single is None:
+                        single = throughput
+                    efficiency = throughput / (workers * single)
+                    line += ' calls/s=%.0f efficiency=%.0f%%' % (throughput, 100 * efficiency)
+                if flag:
+                    line += ' ' + flag
+                    problems.append(line)
+                print(line)
+                sys.stdout.flush()
+
+    for className, methodName in SKIPPED:
+        print('%s.%s skipped: its parameters are not plain numeric values.' %
+                (className, methodName))
+    if problems:
+        print('\\n%d problem(s) found:' % len(problems))
+        for problem in problems:
+            print('    ' + problem)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+'''